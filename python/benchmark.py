@@ -0,0 +1,538 @@
+#
+# Benchmark the scoring script's busiest code paths against a simulated
+# Synapse, so their performance can be measured without a live project.
+#
+# The simulated Synapse answers the client calls the scoring script makes
+# from memory, sleeping for a random latency on each call, and keeps count
+# of the calls. Submission files are created as sparse files of random size
+# when they're downloaded. Each phase, validate, score, query, leaderboard,
+# archive and messages, is run in turn over the same submissions, and the
+# throughput, latency percentiles and REST calls per submission of each are
+# reported.
+#
+#   python benchmark.py --submissions 1000 --latency 0.05 --workers 8
+#
+# The benchmark uses challenge_config.py, or challenge_config.template.py if
+# there isn't one, with trivial validation and scoring functions so that it
+# measures the script rather than the scoring code. Give --challenge-functions
+# to use the configured functions instead.
+#
+###############################################################################
+
+
+import argparse
+import hashlib
+import imp
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from synapseclient import Evaluation, Submission, SubmissionStatus, File
+from synapseclient.annotations import from_submission_status_annotations
+from synapseclient.table import RowSet, SelectColumn
+
+try:
+    import challenge_config as conf
+except ImportError:
+    conf = imp.load_source('challenge_config', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'challenge_config.template.py'))
+
+import cache
+import challenge
+import messages
+import schedule
+
+
+PHASES = ('validate', 'score', 'query', 'leaderboard', 'archive', 'messages')
+DISTRIBUTIONS = ('constant', 'exponential', 'lognormal', 'pareto')
+
+EVALUATION_ID = '9600001'
+LEADERBOARD_TABLE_ID = 'syn9600002'
+ARCHIVE_FOLDER_ID = 'syn9600003'
+
+## submission bundles per page, as the Synapse client asks for them
+BUNDLE_PAGE_SIZE = 20
+
+PERCENTILES = (50, 90, 99)
+
+
+def sample(rnd, distribution, mean):
+    """Draw a random value from a distribution with the given mean"""
+    if mean <= 0 or distribution == 'constant':
+        return mean
+    if distribution == 'exponential':
+        return rnd.expovariate(1.0 / mean)
+    if distribution == 'lognormal':
+        ## a sigma of 1 gives a long tail, mu is chosen to keep the mean
+        return rnd.lognormvariate(math.log(mean) - 0.5, 1.0)
+    if distribution == 'pareto':
+        alpha = 2.0
+        return mean * (alpha - 1) / alpha * rnd.paretovariate(alpha)
+    raise ValueError("Unknown distribution \"%s\"" % distribution)
+
+
+def percentile(values, p):
+    """The p-th percentile of a list of values, by the nearest rank, or None if there are none"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+
+class FakeSynapse(object):
+    """
+    Stands in for a logged in Synapse object, holding one evaluation queue
+    of submissions in memory.
+
+    :param submissions:  number of submissions in the queue
+    :param latency:      mean seconds each call takes
+    :param file_size:    mean size of the submitted files in bytes
+    :param unique_files: number of distinct files among the submissions, so
+                         that some are resubmissions of the same file, by
+                         default all are distinct
+    :param users:        number of participants
+    :param workdir:      directory in which to create downloaded files
+    """
+    def __init__(self, submissions, latency=0.0, latency_distribution='exponential',
+                 file_size=10000, size_distribution='lognormal', unique_files=None,
+                 users=100, workdir=None, seed=0):
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.latency_distribution = latency_distribution
+        self.workdir = workdir or tempfile.mkdtemp(prefix='benchmark_')
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.call_times = []
+        self.started = {}
+        self.finished = {}
+        self.table = OrderedDict()
+        self.table_index = {}
+        self.entities = 0
+        self.query_rows = {}
+
+        self.evaluation = Evaluation(id=EVALUATION_ID, name='Benchmark queue', contentSource='syn9600000')
+        self.submissions = OrderedDict()
+        self.statuses = {}
+        for i in range(submissions):
+            submission_id = str(9700000 + i)
+            content = i % unique_files if unique_files else i
+            file_handle = dict(id=str(8000000 + content), fileName='predictions_%d.txt' % content,
+                               contentMd5=hashlib.md5(str(content)).hexdigest(),
+                               contentSize=int(sample(self.random, size_distribution, file_size)))
+            user_id = str(3000000 + i % users)
+            submission = dict(id=submission_id, name='submission %d' % i, userId=user_id,
+                              evaluationId=EVALUATION_ID, entityId='syn%d' % (7000000 + i), versionNumber=1,
+                              createdOn='2016-01-01T00:00:00.000Z',
+                              entityBundleJSON=json.dumps({'fileHandles': [file_handle],
+                                                           'entity': {'dataFileHandleId': file_handle['id']}}))
+            ## half of the participants submit as a team
+            if int(user_id) % 2:
+                submission['teamId'] = str(4000000 + int(user_id) % 10)
+            self.submissions[submission_id] = submission
+            self.statuses[submission_id] = dict(id=submission_id, status='RECEIVED', etag='0',
+                                                modifiedOn='2016-01-01T00:00:00.000Z')
+
+    def _call(self, name):
+        """Count a REST call and wait for it, as if it went to Synapse"""
+        delay = sample(self.random, self.latency_distribution, self.latency)
+        with self.lock:
+            self.calls[name] += 1
+            self.call_times.append(delay)
+        if delay > 0:
+            time.sleep(delay)
+
+    def reset(self):
+        """Start counting afresh for the next phase"""
+        with self.lock:
+            self.calls = Counter()
+            self.call_times = []
+            self.started = {}
+            self.finished = {}
+
+    def close(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _submission(self, submission_id):
+        return Submission(**self.submissions[submission_id])
+
+    def _store_status(self, status):
+        with self.lock:
+            stored = dict(status)
+            stored['etag'] = str(int(self.statuses[status['id']]['etag']) + 1)
+            self.statuses[status['id']] = stored
+            self.query_rows = {}
+            self.finished[status['id']] = time.time()
+        return SubmissionStatus(**stored)
+
+    ## evaluations and submissions
+
+    def getEvaluation(self, evaluation):
+        self._call('GET /evaluation')
+        return self.evaluation
+
+    def getSubmissionBundles(self, evaluation, status=None, myOwn=False, limit=BUNDLE_PAGE_SIZE, offset=0):
+        with self.lock:
+            matching = [submission_id for submission_id in self.submissions
+                        if status is None or self.statuses[submission_id]['status'] == status]
+        while True:
+            self._call('GET /evaluation/submission/bundle/all')
+            page = matching[offset:offset+limit]
+            for submission_id in page:
+                yield self._submission(submission_id), SubmissionStatus(**self.statuses[submission_id])
+            if len(page) < limit:
+                return
+            offset += limit
+
+    def getSubmission(self, id, downloadFile=True, **kwargs):
+        submission_id = unicode(id['id'] if isinstance(id, dict) else id)
+        with self.lock:
+            self.started.setdefault(submission_id, time.time())
+        self._call('GET /evaluation/submission')
+        submission = self._submission(submission_id)
+        if downloadFile:
+            self._call('GET /file')
+            file_handle = json.loads(submission.entityBundleJSON)['fileHandles'][0]
+            path = os.path.join(self.workdir, '%s_%s' % (submission_id, file_handle['fileName']))
+            ## a sparse file takes no time to write
+            with open(path, 'wb') as f:
+                f.truncate(file_handle['contentSize'])
+            submission.filePath = path
+        return submission
+
+    def getSubmissionStatus(self, id):
+        self._call('GET /evaluation/submission/status')
+        return SubmissionStatus(**self.statuses[unicode(id['id'] if isinstance(id, dict) else id)])
+
+    def store(self, obj, **kwargs):
+        if isinstance(obj, SubmissionStatus):
+            self._call('PUT /evaluation/submission/status')
+            return self._store_status(obj)
+        if isinstance(obj, RowSet):
+            self._call('POST /entity/table/transaction')
+            return self._store_rows(obj)
+        if isinstance(obj, File):
+            self._call('POST /entity')
+            with self.lock:
+                self.entities += 1
+                obj['id'] = 'syn%d' % (9900000 + self.entities)
+            return obj
+        raise ValueError("Can't store a %s" % type(obj).__name__)
+
+    ## REST calls
+
+    def restGET(self, uri, **kwargs):
+        if uri.startswith('/team/'):
+            self._call('GET /team')
+            return dict(id=uri.split('/')[2], name='Team %s' % uri.split('/')[2])
+        if uri.startswith('/evaluation/submission/query'):
+            self._call('GET /evaluation/submission/query')
+            return self._query(urllib.unquote_plus(uri.split('query=', 1)[1]))
+        raise ValueError("No simulated response for GET %s" % uri)
+
+    def restPUT(self, uri, body=None, **kwargs):
+        if uri.endswith('/statusBatch'):
+            self._call('PUT /evaluation/statusBatch')
+            for status in json.loads(body)['statuses']:
+                self._store_status(SubmissionStatus(**status))
+            return {'nextUploadToken': 'token'}
+        raise ValueError("No simulated response for PUT %s" % uri)
+
+    def _query_rows(self, status):
+        """The fields of each submission with the given status, kept until a status changes"""
+        with self.lock:
+            if status in self.query_rows:
+                return self.query_rows[status]
+            rows = []
+            for submission_id, submission in self.submissions.items():
+                submission_status = self.statuses[submission_id]
+                if status and submission_status['status'] != status:
+                    continue
+                fields = dict((key, submission.get(key)) for key in ('userId', 'entityId', 'versionNumber', 'name', 'teamId'))
+                fields.update(objectId=submission_id, status=submission_status['status'], modifiedOn=1451606400000)
+                if 'annotations' in submission_status:
+                    fields.update(from_submission_status_annotations(submission_status['annotations']))
+                rows.append(fields)
+            self.query_rows[status] = rows
+            return rows
+
+    def _query(self, query):
+        """Answer a submission query, supporting a status filter, limit and offset"""
+        words = query.split()
+        limit = int(words[words.index('limit') + 1])
+        offset = int(words[words.index('offset') + 1])
+        status = query.split('status=="', 1)[1].split('"', 1)[0] if 'status=="' in query else None
+        selected = query[len('select '):query.index(' from ')]
+
+        rows = self._query_rows(status)
+        if selected.strip() == '*':
+            headers = sorted(set(key for fields in rows for key in fields)) or ['objectId']
+        else:
+            headers = [name.strip() for name in selected.split(',')]
+        page = rows[offset:offset+limit]
+        return dict(totalNumberOfResults=len(rows), headers=headers,
+                    rows=[dict(values=[fields.get(name, None) for name in headers]) for fields in page])
+
+    ## tables
+
+    def getTableColumns(self, table):
+        self._call('GET /entity/table/columns')
+        columns = conf.leaderboard_columns.get(EVALUATION_ID, conf.LEADERBOARD_COLUMNS)
+        return [dict(id=str(i), name=column['name'], columnType=column['columnType'])
+                for i, column in enumerate(columns)]
+
+    def tableQuery(self, query, resultsAs='rowset', **kwargs):
+        self._call('GET /entity/table/query')
+        object_id = query.split('objectId=', 1)[1].strip() if 'objectId=' in query else None
+        columns = conf.leaderboard_columns.get(EVALUATION_ID, conf.LEADERBOARD_COLUMNS)
+        headers = [SelectColumn(name=column['name'], columnType=column['columnType'], id=str(i))
+                   for i, column in enumerate(columns)]
+        with self.lock:
+            if object_id is None:
+                row_ids = list(self.table)
+            else:
+                row_ids = [self.table_index[object_id]] if object_id in self.table_index else []
+            rows = [dict(rowId=row_id, versionNumber=self.table[row_id]['versionNumber'], values=self.table[row_id]['values'])
+                    for row_id in row_ids]
+        rowset = RowSet(headers=headers, tableId=LEADERBOARD_TABLE_ID, etag='etag', rows=rows)
+
+        class Results(object):
+            def asRowSet(self):
+                return rowset
+        return Results()
+
+    def _store_rows(self, rowset):
+        object_id_index = [column['name'] for column in rowset['headers']].index('objectId')
+        references = []
+        with self.lock:
+            for row in rowset['rows']:
+                row_id = row.get('rowId', None) or len(self.table) + 1
+                version = (row.get('versionNumber', None) or 0) + 1
+                self.table[row_id] = dict(values=row['values'], versionNumber=version)
+                self.table_index[unicode(row['values'][object_id_index])] = row_id
+                references.append(dict(rowId=row_id, versionNumber=version))
+        return dict(rows=references, etag='etag')
+
+    ## users and messages
+
+    def getUserProfile(self, id=None, **kwargs):
+        self._call('GET /userProfile')
+        return dict(ownerId=id, userName='user%s' % id, firstName='Participant', lastName=str(id))
+
+    def sendMessage(self, userIds, messageSubject, messageBody, contentType=None):
+        self._call('POST /message')
+        return dict(id=str(self.calls['POST /message']), recipients=userIds, subject=messageSubject)
+
+
+## ==================================================
+##  Phases
+## ==================================================
+
+def _validate_submission(evaluation, submission):
+    return True, "Looks OK to me!"
+
+
+def _score_submission(evaluation, submission):
+    size = os.path.getsize(submission.filePath)
+    return dict(score=size % 1000 / 1000.0, rmse=size % 97 / 97.0, auc=size % 89 / 89.0), "You did fine!"
+
+
+def _time_each(function, items):
+    """Call a function on each item, returning each call's duration"""
+    durations = []
+    for item in items:
+        start = time.time()
+        function(item)
+        durations.append(time.time() - start)
+    return durations
+
+
+def run_phase(phase, syn, options):
+    """
+    Run one phase of the benchmark.
+
+    :returns: (number of items, durations of each item or None)
+    """
+    evaluation = syn.evaluation
+    processing = dict(workers=options.workers, prefetch_count=options.prefetch,
+                      batch_commit=options.batch_commit, policy=options.schedule)
+
+    if phase == 'validate':
+        return challenge.validate(evaluation, **processing), None
+
+    elif phase == 'score':
+        return challenge.score(evaluation, **processing), None
+
+    elif phase == 'query':
+        columns = conf.leaderboard_columns.get(EVALUATION_ID, conf.LEADERBOARD_COLUMNS)
+        with open(os.devnull, 'w') as out:
+            challenge.query(evaluation, columns, out=out)
+        return len([status for status in syn.statuses.values() if status['status'] == 'SCORED']), None
+
+    elif phase == 'leaderboard':
+        bundles = list(syn.getSubmissionBundles(evaluation, status='SCORED'))
+        syn.reset()
+
+        ## the rows are written as score writes them, in chunks
+        leaderboard = challenge.LeaderboardTableWriter(conf.leaderboard_tables[EVALUATION_ID])
+
+        def update(bundle):
+            submission, status = bundle
+            fields = from_submission_status_annotations(status.annotations) if 'annotations' in status else {}
+            leaderboard.add(submission, fields=fields)
+        durations = _time_each(update, bundles)
+        leaderboard.commit()
+        return len(bundles), durations
+
+    elif phase == 'archive':
+        workdir = os.path.join(syn.workdir, 'archive')
+        challenge.archive(evaluation, ARCHIVE_FOLDER_ID, workdir=workdir, threads=options.workers)
+        shutil.rmtree(workdir, ignore_errors=True)
+        return len([status for status in syn.statuses.values() if status['status'] == 'SCORED']), None
+
+    elif phase == 'messages':
+        submissions = syn.submissions.values()
+
+        def send(submission):
+            messages.send_message(userIds=[submission['userId']],
+                                  subject_template="Submission to \"{queue_name}\" scored",
+                                  message_template="Dear {username},\n\nYour submission {submission_id} has been scored.",
+                                  kwargs=dict(queue_name=evaluation.name, username=submission['userId'],
+                                              submission_id=submission['id']))
+        return len(submissions), _time_each(send, submissions)
+
+    raise ValueError("Unknown phase \"%s\"" % phase)
+
+
+@contextmanager
+def _quiet(verbose):
+    """Hide the output of the code being benchmarked"""
+    if verbose:
+        yield
+        return
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def benchmark(syn, phases, options):
+    """
+    Run each phase and measure it.
+
+    :returns: a list of dictionaries of results, one per phase
+    """
+    results = []
+    for phase in phases:
+        syn.reset()
+        start = time.time()
+        with _quiet(options.verbose):
+            items, durations = run_phase(phase, syn, options)
+        elapsed = time.time() - start
+
+        ## for validate and score, a submission's latency runs from when
+        ## its download starts to when its status is stored
+        if durations is None and syn.finished:
+            durations = [syn.finished[i] - syn.started[i] for i in syn.finished if i in syn.started]
+
+        calls = sum(syn.calls.values())
+        results.append(OrderedDict([
+            ('phase', phase),
+            ('items', items),
+            ('seconds', elapsed),
+            ('items_per_second', items / elapsed if elapsed else 0.0),
+            ('calls', calls),
+            ('calls_per_item', float(calls) / items if items else 0.0),
+            ('latency', OrderedDict(('p%d' % p, percentile(durations or [], p)) for p in PERCENTILES)),
+            ('call_latency', OrderedDict(('p%d' % p, percentile(syn.call_times, p)) for p in PERCENTILES)),
+            ('calls_by_endpoint', OrderedDict(sorted(syn.calls.items())))]))
+    return results
+
+
+def report(results, out=sys.stdout):
+    out.write("%-12s %8s %9s %10s %8s %10s %27s\n" % (
+        'phase', 'items', 'seconds', 'items/s', 'calls', 'calls/item', 'latency ms p50/p90/p99'))
+    for result in results:
+        latency = '/'.join('-' if value is None else '%.1f' % (value * 1000) for value in result['latency'].values())
+        out.write("%-12s %8d %9.2f %10.1f %8d %10.2f %27s\n" % (
+            result['phase'], result['items'], result['seconds'], result['items_per_second'],
+            result['calls'], result['calls_per_item'], latency))
+    out.write("\nREST calls per item\n")
+    for result in results:
+        for endpoint, count in result['calls_by_endpoint'].items():
+            out.write("%-12s %-40s %8.2f\n" % (result['phase'], endpoint, float(count) / result['items'] if result['items'] else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scoring script against a simulated Synapse")
+    parser.add_argument("--submissions", metavar="N", type=int, default=1000, help="Number of submissions in the queue")
+    parser.add_argument("--latency", metavar="SECONDS", type=float, default=0.0, help="Mean latency of each Synapse call")
+    parser.add_argument("--latency-distribution", choices=DISTRIBUTIONS, default='exponential')
+    parser.add_argument("--file-size", metavar="BYTES", type=int, default=10000, help="Mean size of the submitted files")
+    parser.add_argument("--size-distribution", choices=DISTRIBUTIONS, default='lognormal')
+    parser.add_argument("--unique-files", metavar="N", type=int, default=None, help="Number of distinct files, the rest are resubmissions")
+    parser.add_argument("--users", metavar="N", type=int, default=100, help="Number of participants")
+    parser.add_argument("--phases", default=','.join(PHASES), help="Comma separated phases to run, from %s" % ', '.join(PHASES))
+    parser.add_argument("--workers", metavar="N", type=int, default=1, help="Workers for validate and score, threads for archive")
+    parser.add_argument("--prefetch", metavar="N", type=int, default=None, help="Number of submission files to download ahead, by default one per worker")
+    parser.add_argument("--batch-commit", action="store_true", default=False, help="Store submission statuses in batches")
+    parser.add_argument("--schedule", choices=schedule.POLICIES, default='fifo', help="Order in which to work on waiting submissions")
+    parser.add_argument("--send-messages", action="store_true", default=False, help="Message participants during validate and score")
+    parser.add_argument("--challenge-functions", action="store_true", default=False, help="Use the configured validation and scoring functions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="FILE", default=None, help="Also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", default=False, help="Show the output of the code being benchmarked")
+    args = parser.parse_args()
+
+    phases = [phase.strip() for phase in args.phases.split(',') if phase.strip()]
+    for phase in phases:
+        if phase not in PHASES:
+            parser.error("unknown phase \"%s\"" % phase)
+
+    syn = FakeSynapse(args.submissions, latency=args.latency, latency_distribution=args.latency_distribution,
+                      file_size=args.file_size, size_distribution=args.size_distribution,
+                      unique_files=args.unique_files, users=args.users, seed=args.seed)
+
+    ## point the scoring script at the simulated queue
+    conf.evaluation_queues = [dict(id=EVALUATION_ID, name=syn.evaluation.name)]
+    conf.evaluation_queue_by_id = {EVALUATION_ID: conf.evaluation_queues[0]}
+    conf.leaderboard_columns[EVALUATION_ID] = conf.LEADERBOARD_COLUMNS + [
+        dict(name='score', display_name='Score', columnType='DOUBLE'),
+        dict(name='rmse',  display_name='RMSE',  columnType='DOUBLE'),
+        dict(name='auc',   display_name='AUC',   columnType='DOUBLE')]
+    conf.leaderboard_tables[EVALUATION_ID] = LEADERBOARD_TABLE_ID
+    if not args.challenge_functions:
+        conf.validate_submission = _validate_submission
+        conf.score_submission = _score_submission
+    challenge.syn = syn
+    challenge.name_cache = cache.PersistentCache()
+    messages.syn = syn
+    messages.send_messages = args.send_messages
+
+    print "Benchmarking %d submissions, %s latency of %g seconds per call, %s file sizes of %d bytes" % (
+        args.submissions, args.latency_distribution, args.latency, args.size_distribution, args.file_size)
+    try:
+        results = benchmark(syn, phases, args)
+    finally:
+        syn.close()
+
+    print
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(settings=vars(args), results=results), f, indent=2)
+        print "\nWrote results to:", args.json
+
+
+if __name__ == '__main__':
+    main()
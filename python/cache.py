@@ -0,0 +1,82 @@
+## A small key-value cache, held in memory and optionally backed by a
+## SQLite file so that entries survive between runs of the scoring script.
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class PersistentCache(object):
+    """
+    Caches JSON serializable values by string key.
+
+    :param path:        SQLite file in which to keep entries between runs,
+                        or None to only cache in memory
+    :param ttl:         a timedelta after which entries expire, or None
+    :param max_entries: the number of entries to keep, the least recently
+                        cached are dropped from memory as new ones come in
+                        and from disk when the cache is opened and closed
+    """
+    def __init__(self, path=None, ttl=None, max_entries=None):
+        self.path = path
+        self.ttl = ttl.total_seconds() if ttl is not None else None
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("create table if not exists cache (key text primary key, value text, stored real)")
+            self.db.execute("create index if not exists cache_stored on cache (stored)")
+            self._evict()
+
+    def _expired(self, stored):
+        return self.ttl is not None and time.time() - stored > self.ttl
+
+    def get(self, key, default=None):
+        """Return the value cached under key or default if it's missing or expired"""
+        with self.lock:
+            if key not in self.entries and self.db:
+                row = self.db.execute("select value, stored from cache where key=?", (key,)).fetchone()
+                if row:
+                    self._remember(key, json.loads(row[0]), row[1])
+            if key in self.entries:
+                value, stored = self.entries[key]
+                if not self._expired(stored):
+                    return value
+                del self.entries[key]
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            stored = time.time()
+            self._remember(key, value, stored)
+            if self.db:
+                self.db.execute("insert or replace into cache (key, value, stored) values (?,?,?)",
+                                (key, json.dumps(value), stored))
+                self.db.commit()
+
+    def _remember(self, key, value, stored):
+        """Hold an entry in memory, dropping the least recently cached past max_entries"""
+        self.entries.pop(key, None)
+        self.entries[key] = (value, stored)
+        while self.max_entries and len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _evict(self):
+        """Drop expired entries from the file and keep at most max_entries"""
+        if self.ttl is not None:
+            self.db.execute("delete from cache where stored < ?", (time.time() - self.ttl,))
+        if self.max_entries:
+            self.db.execute("delete from cache where key not in (select key from cache order by stored desc limit ?)",
+                            (self.max_entries,))
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db:
+                self._evict()
+                self.db.close()
+                self.db = None
@@ -24,25 +24,36 @@ from synapseclient import Project, Folder, File
 from synapseclient import Evaluation, Submission, SubmissionStatus
 from synapseclient import Wiki
 from synapseclient import Column
+from synapseclient.table import Row, RowSet, SelectColumn
 from synapseclient.dict_object import DictObject
 from synapseclient.annotations import from_submission_status_annotations
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from itertools import izip
+from itertools import chain, islice, izip
+from multiprocessing.pool import ThreadPool
 from StringIO import StringIO
 import copy
+import gzip
+import hashlib
 
 import argparse
+import cache
+import claims
+import filevalidator
 import lock
 import json
 import math
+import multiprocessing
 import os
 import random
 import re
+import shutil
+import signal
 import sys
 import tarfile
 import tempfile
+import threading
 import time
 import traceback
 import urllib
@@ -56,19 +67,109 @@ except Exception as ex1:
     raise ex1
 
 import messages
+import outbox
+import prefetch
+import sandbox
+import schedule
+import statestore
+import synio
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-# the batch size can be bigger, we do this just to demonstrate batching
+## ranking and significance testing need numpy
+try:
+    import goldstandard
+    import metrics
+    import rank as ranking
+    import significance as stats
+except ImportError:
+    goldstandard = None
+    metrics = None
+    ranking = None
+    stats = None
+
+
+# number of statuses in the first request to the statusBatch endpoint, after
+# which the batch size adapts to the size of the payload and the latency
 BATCH_SIZE = 20
 
+# the statusBatch endpoint accepts at most 500 statuses in a request
+MAX_BATCH_SIZE = 500
+
+# aim for requests to the statusBatch endpoint of about this many seconds
+# and no more than this many bytes
+BATCH_TARGET_SECONDS = 2.0
+BATCH_MAX_BYTES = 1024*1024
+
+# seconds to wait for a scoring worker process before giving up on the
+# submission, which also covers workers that die mid-task and never return.
+# The queue's sandbox wall_time plus SCORING_TIMEOUT_MARGIN is used instead
+# when it has one.
+SCORING_TIMEOUT = 6*60*60
+SCORING_TIMEOUT_MARGIN = 60
+
+# the submission query index is updated asynchronously, so incremental
+# leaderboard snapshots look back this many minutes before the latest
+# modifiedOn they've seen, to catch rows indexed after the previous run
+SNAPSHOT_LOOKBACK_MINUTES = 30
+
+# seconds between polls of the evaluation queues in serve mode, starting at
+# the minimum and backing off to the maximum while the queues are idle
+SERVE_MIN_INTERVAL = 30
+SERVE_MAX_INTERVAL = 600
+
 # how many times to we retry batch uploads of submission annotations
 BATCH_UPLOAD_RETRY_COUNT = 5
 
+# maximum number of rows stored in one request to a leaderboard table
+LEADERBOARD_CHUNK_SIZE = 1000
+
+# submission queries fetch a first page of QUERY_PAGE_SIZE results, then
+# up to QUERY_CONCURRENCY pages at a time of up to QUERY_MAX_PAGE_SIZE
+QUERY_PAGE_SIZE = 100
+QUERY_MAX_PAGE_SIZE = 500
+QUERY_CONCURRENCY = 4
+
+# submission bundles per request when the bundles are paged concurrently
+BUNDLE_PAGE_SIZE = 100
+
+# number of submission files downloaded at once while archiving
+ARCHIVE_DOWNLOAD_THREADS = 8
+
+# threads used by the zstd compressor, -1 for one per CPU
+ARCHIVE_COMPRESSION_THREADS = -1
+
+ARCHIVE_EXTENSIONS = {'gz': '.tgz', 'zst': '.tar.zst', 'none': '.tar'}
+
+EVALUATION_QUERY_REGEX = re.compile(r'\sfrom\s+evaluation_(\d+)', re.IGNORECASE)
+
 UUID_REGEX = re.compile('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
 
 # A module level variable to hold the Synapse connection
 syn = None
 
+# User and team names, replaced by a cache backed by a file in main()
+name_cache = cache.PersistentCache()
+
+# The lease held by main() while running a command other than validate,
+# score or serve, which take leases per queue
+update_lock = None
+
+# Leases held on queues by this process, see run_leased and acquire_queue_leases
+queue_leases = []
+
+# An optional local mirror of submissions and statuses, see statestore.py
+state_store = None
+
+# Results of the validation and scoring functions by file content, or None
+result_cache = None
+
+# Runs Synapse requests concurrently over pooled connections, see synio.py
+synapse_io = None
+
 
 def to_column_objects(leaderboard_columns):
     """
@@ -90,195 +191,1075 @@ def get_user_name(profile):
     return " ".join(names)
 
 
-def update_submissions_status_batch(evaluation, statuses):
+def _paged_bundles(evaluation, status=None, limit=BUNDLE_PAGE_SIZE):
+    """
+    Iterate over the (submission, status) bundles of an evaluation, like
+    syn.getSubmissionBundles. Once the first page says how many bundles
+    there are, the rest of the pages are fetched concurrently, if we can.
+    """
+    if synapse_io is None:
+        for bundle in syn.getSubmissionBundles(evaluation, status=status):
+            yield bundle
+        return
+
+    uri = "/evaluation/%s/submission/bundle/all?limit=%d" % (utils.id_of(evaluation), limit)
+    if status is not None:
+        uri += "&status=%s" % status
+
+    def fetch_page(offset):
+        return syn.restGET("%s&offset=%d" % (uri, offset))
+
+    first = fetch_page(0)
+    offsets = range(limit, first['totalNumberOfResults'], limit) if first['results'] else []
+    for page in chain([first], synapse_io.imap(fetch_page, offsets)):
+        for bundle in page['results']:
+            yield Submission(**bundle['submission']), SubmissionStatus(**bundle['submissionStatus'])
+
+
+def _bundle_pages(evaluation, status=None, limit=BUNDLE_PAGE_SIZE):
+    """Group the bundles of an evaluation into lists of up to a page each"""
+    bundles = _paged_bundles(evaluation, status=status, limit=limit)
+    while True:
+        page = list(islice(bundles, limit))
+        if not page:
+            return
+        yield page
+
+
+def _engine_submit():
+    """The function with which to run work on the request engine, or None"""
+    return synapse_io.submit if synapse_io else None
+
+
+def submission_bundles(evaluation, status=None):
+    """
+    Iterate over the (submission, status) bundles of an evaluation, keeping
+    the local state store, if there is one, in sync with what we see.
+    """
+    for page in _bundle_pages(evaluation, status=status):
+        if state_store:
+            state_store.record_bundles(page)
+        for submission, submission_status in page:
+            yield submission, submission_status
+
+
+def check_leases():
+    """Raise LeaseLostException, to stop what we're doing, if we've lost a lease"""
+    for lease in queue_leases + ([update_lock] if update_lock else []):
+        lease.check()
+
+
+def store_status(status):
+    """Store a submission status in Synapse and in the local state store"""
+    check_leases()
+    status = syn.store(status)
+    if state_store:
+        state_store.record_status(status)
+    return status
+
+
+def lookup_user_name(user_id):
+    """Get a user's display name, from the name cache if we've seen them before"""
+    key = 'user:%s' % user_id
+    name = name_cache.get(key)
+    if name is None:
+        name = get_user_name(syn.getUserProfile(user_id))
+        name_cache.put(key, name)
+    return name
+
+
+def lookup_team_name(team_id):
+    """Get a team's name, from the name cache if we've seen it before"""
+    key = 'team:%s' % team_id
+    name = name_cache.get(key)
+    if name is None:
+        team = syn.restGET('/team/{id}'.format(id=team_id))
+        name = team['name'] if 'name' in team else team_id
+        name_cache.put(key, name)
+    return name
+
+
+def _prime_names(bundles):
+    """
+    Look up the names of the people and teams behind the given submissions
+    concurrently, so later lookups are answered from the name cache.
+    """
+    if synapse_io is None:
+        return
+    user_ids = set(submission.userId for submission, status in bundles if 'userId' in submission)
+    team_ids = set(submission.teamId for submission, status in bundles if 'teamId' in submission)
+    for name in synapse_io.imap(lookup_user_name, user_ids):
+        pass
+    for name in synapse_io.imap(lookup_team_name, team_ids):
+        pass
+
+
+def _next_batch_size(batch_size, payload_bytes, elapsed):
+    """
+    Grow or shrink the number of statuses sent per request to aim for
+    requests that take about BATCH_TARGET_SECONDS and stay under
+    BATCH_MAX_BYTES.
+    """
+    factor = min(2.0, max(0.5, BATCH_TARGET_SECONDS / max(elapsed, 0.001)))
+    size = int(batch_size * factor)
+    bytes_per_status = float(payload_bytes) / batch_size
+    size = min(size, int(BATCH_MAX_BYTES / bytes_per_status))
+    return max(1, min(MAX_BATCH_SIZE, size))
+
+
+def update_submissions_status_batch(evaluation, statuses, batch_size=BATCH_SIZE):
     """
     Update statuses in batch. This can be much faster than individual updates,
     especially in rank based scoring methods which recalculate scores for all
     submissions each time a new submission is received.
-    """
 
+    The statuses are sent in as many requests as it takes, adapting the number
+    per request to the payload size and latency. Each request is committed on
+    its own, so on a 412 ConflictingUpdateException only the statuses not yet
+    stored are retried, as a new batch. Those are checked against Synapse
+    first: any that someone else has changed since we read them are reported
+    and left alone rather than overwritten.
+
+    If it fails, the exception's stored_ids attribute holds the ids of the
+    statuses that were stored before the failure.
+
+    :param batch_size: number of statuses to send in the first request
+    :returns: the batch size to start with next time, and a list of the
+              statuses that weren't stored because someone else changed them
+    """
+    check_leases()
+    remaining = list(statuses)
+    stored_ids = set()
+    conflicts = []
+    size = batch_size
     for retry in range(BATCH_UPLOAD_RETRY_COUNT):
         try:
             token = None
-            offset = 0
-            while offset < len(statuses):
-                batch = {"statuses"     : statuses[offset:offset+BATCH_SIZE],
-                         "isFirstBatch" : (offset==0),
-                         "isLastBatch"  : (offset+BATCH_SIZE>=len(statuses)),
+            first = True
+            while remaining:
+                batch = {"statuses"     : remaining[:size],
+                         "isFirstBatch" : first,
+                         "isLastBatch"  : (size>=len(remaining)),
                          "batchToken"   : token}
-                response = syn.restPUT("/evaluation/%s/statusBatch" % evaluation.id, json.dumps(batch))
+                payload = json.dumps(batch)
+                start = time.time()
+                response = syn.restPUT("/evaluation/%s/statusBatch" % utils.id_of(evaluation), payload)
                 token = response.get('nextUploadToken', None)
-                offset += BATCH_SIZE
-        except SynapseHTTPError as err:
+                first = False
+                stored_ids.update(status['id'] for status in batch["statuses"])
+                remaining = remaining[len(batch["statuses"]):]
+                size = _next_batch_size(len(batch["statuses"]), len(payload), time.time() - start)
+            return size, conflicts
+        except Exception as err:
             # on 412 ConflictingUpdateException we want to retry
-            if err.response.status_code == 412:
-                # sys.stderr.write('%s, retrying...\n' % err.message)
-                time.sleep(2)
+            if isinstance(err, SynapseHTTPError) and err.response is not None and err.response.status_code == 412 \
+                    and retry < BATCH_UPLOAD_RETRY_COUNT-1:
+                sys.stderr.write('Conflicting status update, retrying the %d statuses not yet stored...\n' % len(remaining))
+                time.sleep(2**retry)
+                changed = _changed_by_others(remaining)
+                for status in changed:
+                    sys.stderr.write('Status of submission %s was changed by someone else, not updating it\n' % status['id'])
+                conflicts.extend(changed)
+                remaining = [status for status in remaining if not any(status is other for other in changed)]
             else:
+                err.stored_ids = stored_ids
                 raise
 
 
+def _fetch_statuses(submission_ids):
+    """Get the current statuses of several submissions, concurrently if we can"""
+    if synapse_io:
+        return synapse_io.imap(syn.getSubmissionStatus, submission_ids)
+    return (syn.getSubmissionStatus(submission_id) for submission_id in submission_ids)
+
+
+def _changed_by_others(statuses):
+    """
+    Find the statuses whose etags no longer match the ones in Synapse,
+    because someone else has updated them since we read them.
+    """
+    return [status for status, current in izip(statuses, _fetch_statuses([status['id'] for status in statuses]))
+            if current['etag'] != status['etag']]
+
+
+def _record_stored_statuses(statuses):
+    """
+    Record statuses stored through statusBatch in the state store. The
+    statusBatch response carries only an upload token, not the new etags,
+    so the statuses are recorded without an etag rather than with a stale
+    one, and the next sync fills it in.
+    """
+    if not state_store:
+        return
+    state_store.record_statuses([dict(status, etag=None) for status in statuses])
+
+
+class StatusBatcher(object):
+    """
+    Collects submission statuses for an evaluation and stores them through
+    the statusBatch endpoint rather than one at a time. Each status can come
+    with a callback, for sending the participant a message for example,
+    which is called only once the batch holding the status has been stored.
+
+    :param before_flush: optionally, a function called before each batch is
+                         stored, to commit a LeaderboardTableWriter's rows
+                         ahead of the statuses that refer to them
+    """
+    def __init__(self, evaluation, dry_run=False, before_flush=None):
+        self.evaluation = evaluation
+        self.dry_run = dry_run
+        self.before_flush = before_flush
+        self.batch_size = BATCH_SIZE
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def add(self, status, callback=None):
+        with self.lock:
+            self.pending.append((status, callback))
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Store the pending statuses, then call the callbacks of those stored.
+        Those that can't be stored are kept for the next flush and the error
+        is raised; those someone else has changed meanwhile are dropped.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+            stored, error = pending, None
+            if pending and not self.dry_run:
+                try:
+                    check_leases()
+                    if self.before_flush:
+                        self.before_flush()
+                    statuses = [status for status, callback in pending]
+                    self.batch_size, conflicts = update_submissions_status_batch(self.evaluation, statuses, self.batch_size)
+                    stored = [(status, callback) for status, callback in pending
+                              if not any(status is other for other in conflicts)]
+                except Exception as ex1:
+                    error = sys.exc_info()
+                    stored_ids = getattr(ex1, 'stored_ids', set())
+                    stored = [(status, callback) for status, callback in pending if status['id'] in stored_ids]
+                    kept = [(status, callback) for status, callback in pending if status['id'] not in stored_ids]
+                    sys.stderr.write('\nFailed to store a batch of %d statuses in evaluation %s, keeping them to retry\n' % (
+                        len(kept), utils.id_of(self.evaluation)))
+                    self.pending = kept + self.pending
+                _record_stored_statuses([status for status, callback in stored])
+        for status, callback in stored:
+            if callback:
+                callback()
+        if error:
+            raise error[0], error[1], error[2]
+
+
+def _flush_after_error(batcher, evaluation):
+    """
+    Store the statuses batched before an error, reporting rather than
+    raising any failure to do so, so the original error isn't replaced.
+    """
+    if batcher is None:
+        return
+    try:
+        batcher.flush()
+    except Exception:
+        sys.stderr.write('\n\nError storing statuses after an error in evaluation %s:\n' % utils.id_of(evaluation))
+        traceback.print_exc()
+
+
+def project_query(query, columns):
+    """Replace the "select *" of a submission query with a list of columns"""
+    return re.sub(r'^\s*select\s+\*', 'select ' + ', '.join(columns), query, count=1, flags=re.IGNORECASE)
+
+
 class Query(object):
     """
     An object that helps with paging through annotation query results.
 
     Also exposes properties totalNumberOfResults, headers and rows.
+    Call close() to stop early, before all the results have been read.
+
+    Once the first page tells us how many results there are, the remaining
+    pages are fetched up to `concurrency` at a time, with a page size chosen
+    to spread the remaining results over enough requests to keep them busy.
+    The pages are fetched on the request engine if there is one, otherwise
+    on a pool of threads of the query's own.
+
+    If there's a local state store, the rows of each page are recorded in
+    it as they arrive.
+
+    :param columns: optionally, names of the columns to select in place of
+                    the "select *" in the query
     """
-    def __init__(self, query, limit=20, offset=0):
+    def __init__(self, query, limit=QUERY_PAGE_SIZE, offset=0, columns=None, concurrency=QUERY_CONCURRENCY):
+        if columns:
+            query = project_query(query, columns)
         self.query = query
+        match = EVALUATION_QUERY_REGEX.search(query)
+        self.evaluation_id = match.group(1) if match else None
         self.limit = limit
         self.offset = offset
+        self.concurrency = concurrency
+        self.page_offsets = deque()
+        self.pending = deque()
+        self.pool = None
         self.fetch_batch_of_results()
 
+    def _fetch(self, offset, limit):
+        uri = "/evaluation/submission/query?query=" + urllib.quote_plus("%s limit %s offset %s" % (self.query, limit, offset))
+        return syn.restGET(uri)
+
     def fetch_batch_of_results(self):
-        uri = "/evaluation/submission/query?query=" + urllib.quote_plus("%s limit %s offset %s" % (self.query, self.limit, self.offset))
-        results = syn.restGET(uri)
+        results = self._fetch(self.offset, self.limit)
         self.totalNumberOfResults = results['totalNumberOfResults']
         self.headers = results['headers']
         self.rows = results['rows']
         self.i = 0
+        self._mirror()
+
+        ## plan out the rest of the pages
+        start = self.offset + len(self.rows)
+        remaining = self.totalNumberOfResults - start
+        self.page_size = max(self.limit, min(QUERY_MAX_PAGE_SIZE, int(math.ceil(float(remaining) / (4*self.concurrency)))))
+        self.page_offsets = deque(range(start, self.totalNumberOfResults, self.page_size)) if self.rows else deque()
+
+    def _submit(self, offset):
+        if synapse_io:
+            return synapse_io.submit(self._fetch, offset, self.page_size)
+        if self.pool is None:
+            self.pool = ThreadPool(processes=self.concurrency)
+        return self.pool.apply_async(self._fetch, (offset, self.page_size))
+
+    def _fetch_next_page(self):
+        while self.page_offsets and len(self.pending) < self.concurrency:
+            self.pending.append(self._submit(self.page_offsets.popleft()))
+        try:
+            results = self.pending.popleft().get()
+        except:
+            self._shut_down_pool()
+            raise
+        self.rows = results['rows']
+        self.i = 0
+        self._mirror()
+        if not self.pending and not self.page_offsets:
+            self._shut_down_pool()
+
+    def _mirror(self):
+        if state_store and self.evaluation_id:
+            state_store.record_query_rows(self.evaluation_id, self.headers, (row['values'] for row in self.rows))
+
+    def _shut_down_pool(self):
+        self.page_offsets.clear()
+        if self.pool is not None:
+            if self.pending:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.pending.clear()
+
+    def close(self):
+        """Stop early, discarding any results not yet read"""
+        self._shut_down_pool()
+        self.rows = []
+        self.i = 0
 
     def __iter__(self):
         return self
 
     def next(self):
-        if self.i >= len(self.rows):
-            if self.offset >= self.totalNumberOfResults:
+        while self.i >= len(self.rows):
+            if not self.page_offsets and not self.pending:
                 raise StopIteration()
-            self.fetch_batch_of_results()
+            self._fetch_next_page()
         values = self.rows[self.i]['values']
         self.i += 1
         self.offset += 1
         return values
 
 
-def validate(evaluation, dry_run=False):
+def _claimable_bundles(evaluation, status, phase, claim, policy='fifo'):
+    """
+    List the bundles with the given status in the order given by the
+    scheduling policy. When claiming, add submissions whose claims on this
+    phase have expired and return a generator that claims each bundle as
+    it's reached, dropping those another host got to first.
 
-    if type(evaluation) != Evaluation:
-        evaluation = syn.getEvaluation(evaluation)
+    :returns: (bundles, bundles to work on)
+    """
+    bundles = list(submission_bundles(evaluation, status=status))
+    if claim:
+        bundles += claims.expired_claims(submission_bundles(evaluation, status=claims.IN_PROGRESS), phase)
+    bundles = schedule.order(bundles, policy)
+    if not claim:
+        return bundles, bundles
+    ttl = getattr(conf, 'CLAIM_TTL_MINUTES', claims.DEFAULT_CLAIM_TTL/60)*60
+    return bundles, claims.claim_bundles(syn, bundles, phase, ttl=ttl, store=store_status)
+
+
+def _send_validation_message(evaluation, submission, is_valid, validation_message):
+    if is_valid:
+        messages.validation_passed(
+            userIds=[submission.userId],
+            username=lookup_user_name(submission.userId),
+            queue_name=evaluation.name,
+            submission_id=submission.id,
+            submission_name=submission.name)
+    else:
+        messages.validation_failed(
+            userIds=[submission.userId],
+            username=lookup_user_name(submission.userId),
+            queue_name=evaluation.name,
+            submission_id=submission.id,
+            submission_name=submission.name,
+            message=validation_message)
 
-    print "\n\nValidating", evaluation.id, evaluation.name
-    print "-" * 60
-    sys.stdout.flush()
 
+def _result_cache_key(kind, evaluation, submission):
+    """
+    Key results by the MD5 of the submitted file, the evaluation and the
+    version of the configured function, or None if results can't be cached.
+    """
+    if result_cache is None:
+        return None
+    md5 = prefetch.content_md5(submission)
+    if md5 is None:
+        return None
+    version = getattr(conf, kind.upper() + '_FUNCTION_VERSION', None)
+    return '%s:%s:%s:%s' % (kind, md5, utils.id_of(evaluation), version)
 
-    for submission, status in syn.getSubmissionBundles(evaluation, status='RECEIVED'):
 
-        ## refetch the submission so that we get the file path
-        ## to be later replaced by a "downloadFiles" flag on getSubmissionBundles
-        submission = syn.getSubmission(submission)
+def _preload_goldstandard(evaluation):
+    """
+    Load the gold standard of an evaluation queue configured with a
+    goldstandard_path before any worker processes are forked, so they
+    share its memory map rather than each loading their own.
+    """
+    if goldstandard is None or not hasattr(conf, 'read_goldstandard'):
+        return
+    if 'goldstandard_path' in conf.evaluation_queue_by_id.get(evaluation.id, {}):
+        conf.read_goldstandard(evaluation)
 
-        print "validating", submission.id, submission.name
+
+def _call_limited(function, evaluation, submission):
+    """
+    Call a validation or scoring function, in a child process with limits
+    on time and memory if any are configured for the evaluation queue.
+    """
+    limits = getattr(conf, 'sandbox_limits', {}).get(utils.id_of(evaluation), None)
+    if limits:
+        return sandbox.run(function, (evaluation, submission), **limits)
+    return function(evaluation, submission)
+
+
+def _check_and_validate(evaluation, submission):
+    """
+    Check a submission's file against the queue's schema in
+    conf.submission_schemas, if it has one, then call the configured
+    validation function on files that pass.
+    """
+    schema = getattr(conf, 'submission_schemas', {}).get(evaluation.id, None)
+    if schema:
+        is_valid, validation_message = filevalidator.validate_file(submission.filePath, schema)
+        if not is_valid:
+            return is_valid, validation_message
+    return conf.validate_submission(evaluation, submission)
+
+
+def _validate_submission(evaluation, submission, status, dry_run=False, batcher=None):
+    """
+    Validate a single submission, store its status and message the
+    participant. An exception from the validation function marks the
+    submission INVALID rather than propagating.
+
+    :param submission: a submission refetched so that its file is downloaded
+    :param batcher:    a StatusBatcher to store the status with, or None to
+                       store it right away
+    """
+
+    print "validating", submission.id, submission.name
+    key = _result_cache_key('validation', evaluation, submission)
+    cached = result_cache.get(key) if key else None
+    if cached:
+        print "reusing validation result for identical file"
+        is_valid, validation_message = cached
+    else:
         try:
-            is_valid, validation_message = conf.validate_submission(evaluation, submission)
+            is_valid, validation_message = _call_limited(_check_and_validate, evaluation, submission)
+            if key:
+                result_cache.put(key, [is_valid, validation_message])
         except Exception as ex1:
             is_valid = False
             print "Exception during validation:", type(ex1), ex1, ex1.message
-            traceback.print_exc()
+            if isinstance(ex1, sandbox.ChildError):
+                sys.stderr.write(ex1.traceback)
+            else:
+                traceback.print_exc()
             validation_message = str(ex1)
 
-        status.status = "VALIDATED" if is_valid else "INVALID"
+    status.status = "VALIDATED" if is_valid else "INVALID"
+    claims.release(status)
 
+    ## send message AFTER storing status to ensure we don't get repeat messages
+    if batcher:
+        batcher.add(status, callback=lambda: _send_validation_message(evaluation, submission, is_valid, validation_message))
+    else:
         if not dry_run:
-            status = syn.store(status)
-
-        ## send message AFTER storing status to ensure we don't get repeat messages
-        profile = syn.getUserProfile(submission.userId)
-        if is_valid:
-            messages.validation_passed(
-                userIds=[submission.userId],
-                username=get_user_name(profile),
-                queue_name=evaluation.name,
-                submission_id=submission.id,
-                submission_name=submission.name)
-        else:
-            messages.validation_failed(
-                userIds=[submission.userId],
-                username=get_user_name(profile),
-                queue_name=evaluation.name,
-                submission_id=submission.id,
-                submission_name=submission.name,
-                message=validation_message)
+            status = store_status(status)
+        _send_validation_message(evaluation, submission, is_valid, validation_message)
+
+
+def _fetch_and_validate(evaluation, submission, status, submissions, fetch=False, dry_run=False, batcher=None):
+    """
+    Validate a submission in a pool thread, refetching it there first if it
+    hasn't been downloaded yet, and release its file from the prefetch
+    byte budget once done.
+    """
+    if fetch:
+        submission = syn.getSubmission(submission)
+    try:
+        _validate_submission(evaluation, submission, status, dry_run=dry_run, batcher=batcher)
+    finally:
+        prefetch.release(submissions, submission)
 
 
-def score(evaluation, dry_run=False):
+def _validate_in_pool(evaluation, submissions, workers, fetch=False, dry_run=False, batcher=None):
+    """
+    Validate submissions in a pool of threads, keeping a bounded number of
+    submissions waiting for a thread.
+
+    :param fetch: the submissions haven't been refetched to download their
+                  files, so the pool threads do it
+    """
+    pool = ThreadPool(processes=workers)
+    pending = deque()
+    try:
+        ## get results in order so that unexpected errors (in storing a
+        ## status, for example) are raised here, as in the serial case
+        for submission, status in submissions:
+            pending.append(pool.apply_async(_fetch_and_validate, (evaluation, submission, status, submissions),
+                                            dict(fetch=fetch, dry_run=dry_run, batcher=batcher)))
+            while len(pending) > 2*workers:
+                pending.popleft().get()
+        while pending:
+            pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def validate(evaluation, dry_run=False, workers=1, prefetch_count=None, prefetch_bytes=prefetch.DEFAULT_PREFETCH_BYTES, batch_commit=False, claim=False, policy='fifo'):
+    """
+    Validate all RECEIVED submissions to an evaluation.
+
+    :param workers:        if greater than 1, validate up to this many
+                           submissions at once in a pool of threads
+    :param prefetch_count: number of submission files to download ahead,
+                           by default one per worker. With 0 and several
+                           workers, each worker downloads its own.
+    :param prefetch_bytes: limit on the size of files downloaded ahead or
+                           waiting for a worker
+    :param batch_commit:   store statuses in batches, messaging participants
+                           once their submission's batch is stored
+    :param claim:          claim each submission before validating it, so
+                           that other hosts can work on the same queue
+    :param policy:         order in which to work on submissions, one of
+                           schedule.POLICIES
+    :returns: the number of submissions validated
+    """
 
     if type(evaluation) != Evaluation:
         evaluation = syn.getEvaluation(evaluation)
 
-    print '\n\nScoring ', evaluation.id, evaluation.name
+    ## a sandbox forked from one of several threads can deadlock on a lock
+    ## held by another, so it must be able to time out
+    limits = getattr(conf, 'sandbox_limits', {}).get(evaluation.id, None)
+    if workers > 1 and limits and not limits.get('wall_time', None):
+        raise ValueError("Validating evaluation %s with several workers needs a wall_time in its sandbox_limits" % evaluation.id)
+
+    ## a broken schema is a problem with the challenge, not the submissions
+    schema = getattr(conf, 'submission_schemas', {}).get(evaluation.id, None)
+    if schema:
+        filevalidator.check_schema(schema)
+
+    print "\n\nValidating", evaluation.id, evaluation.name
     print "-" * 60
     sys.stdout.flush()
 
-    for submission, status in syn.getSubmissionBundles(evaluation, status='VALIDATED'):
+    ## Take the whole list up front. The bundles are paged by offset, so
+    ## storing statuses while paging would shift later pages under us.
+    bundles, to_process = _claimable_bundles(evaluation, 'RECEIVED', 'validate', claim and not dry_run, policy)
+    _prime_names(bundles)
+    if bundles:
+        _preload_goldstandard(evaluation)
+
+    if prefetch_count is None:
+        prefetch_count = workers if workers > 1 else 0
+
+    ## refetch the submissions so that we get the file path
+    ## to be later replaced by a "downloadFiles" flag on getSubmissionBundles
+    fetch_in_pool = workers > 1 and prefetch_count == 0
+    if fetch_in_pool:
+        submissions = to_process
+    else:
+        submissions = prefetch.prefetch_submissions(syn, to_process, lookahead=prefetch_count, max_bytes=prefetch_bytes,
+                                                    hold=workers > 1, submit=_engine_submit())
 
-        status.status = "INVALID"
+    batcher = StatusBatcher(evaluation, dry_run=dry_run) if batch_commit else None
 
-        ## refetch the submission so that we get the file path
-        ## to be later replaced by a "downloadFiles" flag on getSubmissionBundles
-        submission = syn.getSubmission(submission)
+    try:
+        if workers > 1:
+            print "validating %d submissions with %d workers" % (len(bundles), workers)
+            _validate_in_pool(evaluation, submissions, workers, fetch=fetch_in_pool, dry_run=dry_run, batcher=batcher)
+        else:
+            for submission, status in submissions:
+                _validate_submission(evaluation, submission, status, dry_run=dry_run, batcher=batcher)
+    except:
+        ## store what was validated before the error, without hiding the error
+        exc_info = sys.exc_info()
+        _flush_after_error(batcher, evaluation)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    if batcher:
+        batcher.flush()
+
+    return len(bundles)
 
-        try:
-            score, message = conf.score_submission(evaluation, submission)
 
+def _score_submission(evaluation, submission):
+    """
+    Run the configured scoring function on a submission. This touches only
+    the submission's file and the challenge config, so it's safe to call in
+    a worker process.
+
+    :returns: (score, message, error) where error is a formatted traceback
+              if the scoring function raised an exception, otherwise None
+    """
+    try:
+        score, message = _call_limited(conf.score_submission, evaluation, submission)
+        return score, message, None
+    except sandbox.LimitExceeded as ex1:
+        return None, str(ex1), str(ex1)
+    except sandbox.ChildError as ex1:
+        return None, ex1.traceback, ex1.traceback
+    except Exception as ex1:
+        st = StringIO()
+        traceback.print_exc(file=st)
+        return None, st.getvalue(), st.getvalue()
+
+
+def _init_worker():
+    ## ignore Ctrl-C in workers, the main process cleans up the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _cached_score(evaluation, submission):
+    """:returns: a result like _score_submission's from the cache, or None"""
+    key = _result_cache_key('scoring', evaluation, submission)
+    cached = result_cache.get(key) if key else None
+    if cached:
+        print "reusing score for identical file", submission.id
+        return cached[0], cached[1], None
+    return None
+
+
+def _score_serially(evaluation, submissions):
+    for submission, status in submissions:
+        yield submission, status, _cached_score(evaluation, submission) or _score_submission(evaluation, submission)
+
+
+def _scoring_timeout(evaluation):
+    """Seconds to wait for a worker to score a submission"""
+    limits = getattr(conf, 'sandbox_limits', {}).get(utils.id_of(evaluation), None)
+    if limits and limits.get('wall_time', None):
+        return limits['wall_time'] + SCORING_TIMEOUT_MARGIN
+    return getattr(conf, 'SCORING_TIMEOUT_SECONDS', SCORING_TIMEOUT)
+
+
+def _score_in_pool(evaluation, submissions, workers):
+    """
+    Fan scoring out to a pool of worker processes, yielding
+    (submission, status, result) in the same order as the submissions, so
+    the caller can store statuses and send messages from the main process.
+
+    A worker killed mid-task, by the OOM killer say, never returns its
+    result, so each result is waited for only so long. When one times out,
+    the submission gets a scoring error and the pool is replaced, with the
+    unfinished submissions sent to the new one.
+    """
+    timeout = _scoring_timeout(evaluation)
+    pools = [multiprocessing.Pool(processes=workers, initializer=_init_worker)]
+    pending = deque()
+
+    def replace_pool():
+        pools[0].terminate()
+        pools[0].join()
+        pools[0] = multiprocessing.Pool(processes=workers, initializer=_init_worker)
+        for i, (submission, status, cached, result) in enumerate(pending):
+            if result is not None and not result.ready():
+                pending[i] = (submission, status, cached, pools[0].apply_async(_score_submission, (evaluation, submission)))
+
+    def finish():
+        submission, status, cached, result = pending.popleft()
+        if cached is None:
+            try:
+                cached = result.get(timeout)
+            except multiprocessing.TimeoutError:
+                message = "Scoring didn't finish within %d seconds" % timeout
+                sys.stderr.write("\n%s for submission %s, restarting the scoring workers\n" % (message, submission.id))
+                cached = (None, message, message)
+                replace_pool()
+        prefetch.release(submissions, submission)
+        return submission, status, cached
+
+    try:
+        for submission, status in submissions:
+            ## only files we haven't scored before go to the workers
+            cached = _cached_score(evaluation, submission)
+            result = None if cached else pools[0].apply_async(_score_submission, (evaluation, submission))
+            pending.append((submission, status, cached, result))
+
+            ## keep a bounded number of downloaded submissions waiting on workers
+            while len(pending) > 2*workers:
+                yield finish()
+
+        while pending:
+            yield finish()
+        pools[0].close()
+    finally:
+        pools[0].terminate()
+        pools[0].join()
+
+
+def _send_scoring_message(evaluation, submission, scored, message):
+    if scored:
+        messages.scoring_succeeded(
+            userIds=[submission.userId],
+            message=message,
+            username=lookup_user_name(submission.userId),
+            queue_name=evaluation.name,
+            submission_name=submission.name,
+            submission_id=submission.id)
+    else:
+        messages.scoring_error(
+            userIds=[submission.userId],
+            message=message,
+            username=lookup_user_name(submission.userId),
+            queue_name=evaluation.name,
+            submission_name=submission.name,
+            submission_id=submission.id)
+
+
+def _store_score(evaluation, submission, status, result, dry_run=False, batcher=None, leaderboard=None):
+    """
+    Record the outcome of scoring a submission: fill in the team, annotate
+    the status, update the leaderboard table, store the status and then
+    message the participant.
+
+    :param batcher:     a StatusBatcher to store the status with, or None to
+                        store it right away
+    :param leaderboard: a LeaderboardTableWriter to add the row to, whose
+                        rows the batcher commits ahead of the statuses
+    """
+    score, message, error = result
+
+    status.status = "INVALID"
+    claims.release(status)
+
+    if error is None:
+        try:
             print "scored:", submission.id, submission.name, submission.userId, score
 
+            key = _result_cache_key('scoring', evaluation, submission)
+            if key:
+                result_cache.put(key, [dict(score), message])
+
             ## fill in team in submission status annotations
             if 'teamId' in submission:
-                team = syn.restGET('/team/{id}'.format(id=submission.teamId))
-                if 'name' in team:
-                    score['team'] = team['name']
-                else:
-                    score['team'] = submission.teamId
+                score['team'] = lookup_team_name(submission.teamId)
             elif 'userId' in submission:
-                profile = syn.getUserProfile(submission.userId)
-                score['team'] = get_user_name(profile)
+                score['team'] = lookup_user_name(submission.userId)
             else:
                 score['team'] = '?'
 
             status.annotations = synapseclient.annotations.to_submission_status_annotations(score,is_private=True)
             status.status = "SCORED"
             ## if there's a table configured, update it
-            if not dry_run and evaluation.id in conf.leaderboard_tables:
-                update_leaderboard_table(conf.leaderboard_tables[evaluation.id], submission, fields=score, dry_run=False)
+            if leaderboard:
+                leaderboard.add(submission, fields=score)
 
-        except Exception as ex1:
-            sys.stderr.write('\n\nError scoring submission %s %s:\n' % (submission.name, submission.id))
+        except Exception:
             st = StringIO()
             traceback.print_exc(file=st)
-            sys.stderr.write(st.getvalue())
-            sys.stderr.write('\n')
-            message = st.getvalue()
+            error = st.getvalue()
 
-            if conf.ADMIN_USER_IDS:
-                submission_info = "submission id: %s\nsubmission name: %s\nsubmitted by user id: %s\n\n" % (submission.id, submission.name, submission.userId)
-                messages.error_notification(userIds=conf.ADMIN_USER_IDS, message=submission_info+st.getvalue())
+    if error is not None:
+        sys.stderr.write('\n\nError scoring submission %s %s:\n' % (submission.name, submission.id))
+        sys.stderr.write(error)
+        sys.stderr.write('\n')
+        message = error
+
+        if conf.ADMIN_USER_IDS:
+            submission_info = "submission id: %s\nsubmission name: %s\nsubmitted by user id: %s\n\n" % (submission.id, submission.name, submission.userId)
+            messages.error_notification(userIds=conf.ADMIN_USER_IDS, message=submission_info+error)
 
+    scored = (status.status == 'SCORED')
+
+    ## send message AFTER storing status to ensure we don't get repeat messages
+    if batcher:
+        batcher.add(status, callback=lambda: _send_scoring_message(evaluation, submission, scored, message))
+    else:
         if not dry_run:
-            status = syn.store(status)
-
-        ## send message AFTER storing status to ensure we don't get repeat messages
-        profile = syn.getUserProfile(submission.userId)
-
-        if status.status == 'SCORED':
-            messages.scoring_succeeded(
-                userIds=[submission.userId],
-                message=message,
-                username=get_user_name(profile),
-                queue_name=evaluation.name,
-                submission_name=submission.name,
-                submission_id=submission.id)
-        else:
-            messages.scoring_error(
-                userIds=[submission.userId],
-                message=message,
-                username=get_user_name(profile),
-                queue_name=evaluation.name,
-                submission_name=submission.name,
-                submission_id=submission.id)
+            status = store_status(status)
+        _send_scoring_message(evaluation, submission, scored, message)
+
+
+def score(evaluation, dry_run=False, workers=1, prefetch_count=None, prefetch_bytes=prefetch.DEFAULT_PREFETCH_BYTES, batch_commit=False, claim=False, policy='fifo'):
+    """
+    Score all VALIDATED submissions to an evaluation.
+
+    :param workers:        if greater than 1, run the scoring function in a
+                           pool of this many processes. Statuses, leaderboard
+                           rows and messages are still handled in order by
+                           this process.
+    :param prefetch_count: number of submission files to download ahead,
+                           by default one per worker
+    :param prefetch_bytes: limit on the size of files downloaded ahead or
+                           waiting for a worker
+    :param batch_commit:   store statuses in batches, messaging participants
+                           once their submission's batch is stored. Queues
+                           with a leaderboard table are always batched.
+    :param claim:          claim each submission before scoring it, so
+                           that other hosts can work on the same queue
+    :param policy:         order in which to work on submissions, one of
+                           schedule.POLICIES
+    :returns: the number of submissions scored
+    """
+
+    if type(evaluation) != Evaluation:
+        evaluation = syn.getEvaluation(evaluation)
+
+    print '\n\nScoring ', evaluation.id, evaluation.name
+    print "-" * 60
+    sys.stdout.flush()
+
+    ## Take the whole list up front. The bundles are paged by offset, so
+    ## storing statuses while paging would shift later pages under us.
+    bundles, to_process = _claimable_bundles(evaluation, 'VALIDATED', 'score', claim and not dry_run, policy)
+    _prime_names(bundles)
+    if bundles:
+        _preload_goldstandard(evaluation)
+
+    if prefetch_count is None:
+        prefetch_count = workers if workers > 1 else 0
+
+    ## refetch the submissions so that we get the file path
+    ## to be later replaced by a "downloadFiles" flag on getSubmissionBundles
+    submissions = prefetch.prefetch_submissions(syn, to_process, lookahead=prefetch_count, max_bytes=prefetch_bytes,
+                                                hold=workers > 1, submit=_engine_submit())
+
+    if workers > 1:
+        print "scoring %d submissions with %d workers" % (len(bundles), workers)
+        results = _score_in_pool(evaluation, submissions, workers)
+    else:
+        results = _score_serially(evaluation, submissions)
+
+    ## if there's a table configured, collect rows to store in bulk
+    leaderboard = None
+    if not dry_run and evaluation.id in conf.leaderboard_tables:
+        leaderboard = LeaderboardTableWriter(conf.leaderboard_tables[evaluation.id])
+
+    ## Statuses must be stored after the leaderboard rows they refer to, so
+    ## with a leaderboard table they're always batched, and each batch's
+    ## rows are committed in one go just before it
+    batcher = None
+    if batch_commit or leaderboard:
+        batcher = StatusBatcher(evaluation, dry_run=dry_run,
+                                before_flush=leaderboard.commit if leaderboard else None)
+
+    try:
+        for submission, status, result in results:
+            _store_score(evaluation, submission, status, result, dry_run=dry_run, batcher=batcher, leaderboard=leaderboard)
+    except:
+        ## store what was scored before the error, without hiding the error
+        exc_info = sys.exc_info()
+        _flush_after_error(batcher, evaluation)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    if batcher:
+        batcher.flush()
 
     sys.stdout.write('\n')
 
+    return len(bundles)
+
+
+def _scored_annotations(evaluation_id):
+    """
+    :returns: the bundles of the SCORED submissions to an evaluation and a
+              list of the annotations of each as a dictionary
+    """
+    bundles = list(submission_bundles(evaluation_id, status='SCORED'))
+    annotations = []
+    for submission, status in bundles:
+        scores = from_submission_status_annotations(status.annotations) if 'annotations' in status else {}
+        for key in ('objectId', 'scopeId'):
+            scores.pop(key, None)
+        annotations.append(scores)
+    return bundles, annotations
+
+
+def _store_annotation_updates(evaluation_id, bundles, annotations, updates, dry_run=False):
+    """
+    Add annotations to the statuses of many submissions, storing only the
+    statuses that change, in batches, and updating the leaderboard table if
+    there is one.
+
+    :param annotations: each submission's current annotations, as returned by _scored_annotations
+    :param updates:     a dictionary of annotations to set for each submission,
+                        where a value of None removes the annotation
+    :returns: the number of statuses changed
+    """
+    changed = []
+    for (submission, status), scores, update in izip(bundles, annotations, updates):
+        updated = dict(scores)
+        for key, value in update.iteritems():
+            if value is None:
+                updated.pop(key, None)
+            else:
+                updated[key] = value
+        if updated == scores:
+            continue
+        status.annotations = synapseclient.annotations.to_submission_status_annotations(updated, is_private=True)
+        changed.append((submission, status, updated))
+
+    if changed and not dry_run:
+        statuses = [status for submission, status, updated in changed]
+        size, conflicts = update_submissions_status_batch(evaluation_id, statuses)
+        changed = [(submission, status, updated) for submission, status, updated in changed
+                   if not any(status is other for other in conflicts)]
+        _record_stored_statuses([status for submission, status, updated in changed])
+        if evaluation_id in conf.leaderboard_tables:
+            leaderboard = LeaderboardTableWriter(conf.leaderboard_tables[evaluation_id])
+            for submission, status, updated in changed:
+                leaderboard.add(submission, fields=dict(updated))
+            leaderboard.commit()
+
+    return len(changed)
+
+
+def rank(evaluation, dry_run=False):
+    """
+    Rank all SCORED submissions to an evaluation by each leaderboard column
+    configured with a 'rank' direction, annotating each submission with its
+    rank, its team's rank and whether it is its team's best. Only statuses
+    whose ranks have changed are stored, in batches.
+    """
+    if ranking is None:
+        raise ImportError("Ranking submissions requires the numpy package")
+
+    evaluation_id = utils.id_of(evaluation)
+    columns = conf.leaderboard_columns.get(evaluation_id, conf.LEADERBOARD_COLUMNS)
+    if not ranking.ranked_columns(columns):
+        sys.stderr.write("\nNo leaderboard columns of evaluation %s are configured with a rank direction\n" % evaluation_id)
+        return 0
+
+    print "\n\nRanking", evaluation_id
+    print "-" * 60
+    sys.stdout.flush()
+
+    bundles, annotations = _scored_annotations(evaluation_id)
+    if not bundles:
+        print "no scored submissions to rank"
+        return 0
+    teams = [unicode(scores.get('team', None) or submission.get('teamId', None) or submission.userId)
+             for (submission, status), scores in izip(bundles, annotations)]
+    updates = ranking.rank_table(annotations, teams, columns)
+
+    changed = _store_annotation_updates(evaluation_id, bundles, annotations, updates, dry_run=dry_run)
+    print "ranked %d submissions, %d changed" % (len(bundles), changed)
+    return changed
+
+
+def _download_submissions(submission_ids):
+    """Download the files of several submissions, concurrently if we can"""
+    if synapse_io:
+        return list(synapse_io.imap(syn.getSubmission, submission_ids))
+    return [syn.getSubmission(submission_id) for submission_id in submission_ids]
+
+
+def significance(evaluation, dry_run=False, top=None, resamples=None, confidence=None, processes=1, seed=None):
+    """
+    Compute bootstrap confidence intervals of the metric configured for an
+    evaluation in conf.significance_tests, for the top scoring submissions,
+    along with Bayes factors comparing each to the best. The results are
+    stored as [column]_ci_low, [column]_ci_high and [column]_bayes_factor
+    annotations, which are removed from submissions no longer in the top.
+    """
+    if stats is None:
+        raise ImportError("Significance testing requires the numpy package")
+
+    evaluation = syn.getEvaluation(evaluation)
+    settings = getattr(conf, 'significance_tests', {}).get(evaluation.id, None)
+    if settings is None:
+        sys.stderr.write("\nNo significance test is configured for evaluation %s\n" % evaluation.id)
+        return 0
+    name = settings['column']
+    top = top or settings.get('top', stats.DEFAULT_TOP)
+    resamples = resamples or settings.get('resamples', stats.DEFAULT_RESAMPLES)
+    confidence = confidence or settings.get('confidence', stats.DEFAULT_CONFIDENCE)
+    columns = conf.leaderboard_columns.get(evaluation.id, conf.LEADERBOARD_COLUMNS)
+    descending = all(column.get('rank', 'descending') != 'ascending' for column in columns if column['name'] == name)
+
+    ## a metric function, the name of one in metrics.py or by default the
+    ## one named by the leaderboard column
+    metric = settings.get('metric', None)
+    if metric is None:
+        metric = next((column.get('metric', None) for column in columns if column['name'] == name), None)
+        if metric is None:
+            raise ValueError("No metric is configured for the significance test of %s" % name)
+    if isinstance(metric, basestring):
+        metric = metrics.get(metric)
+
+    print "\n\nSignificance of", name, "in", evaluation.id, evaluation.name
+    print "-" * 60
+    sys.stdout.flush()
+
+    ## the top submissions by the metric, best first
+    bundles, annotations = _scored_annotations(evaluation.id)
+    scored = [(float(scores[name]), i) for i, scores in enumerate(annotations)
+              if isinstance(scores.get(name, None), (int, long, float)) and not math.isnan(scores[name])]
+    scored.sort(key=lambda value_index: (-value_index[0] if descending else value_index[0], value_index[1]))
+    top_rows = [i for value, i in scored[:top]]
+    if not top_rows:
+        sys.stderr.write("\nNo scored submissions with a value for %s\n" % name)
+        return 0
+
+    gold = conf.read_goldstandard(evaluation)
+    submissions = _download_submissions([bundles[i][0].id for i in top_rows])
+    predictions = [conf.read_predictions(evaluation, submission) for submission in submissions]
+
+    start = time.time()
+    samples = stats.bootstrap(metric, gold, predictions,
+                              resamples=resamples, processes=processes, seed=seed)
+    low, high = stats.confidence_intervals(samples, confidence)
+    factors = stats.bayes_factors(samples, 0, descending=descending)
+    print "evaluated %d resamples of %d submissions in %.1f seconds" % (resamples, len(top_rows), time.time() - start)
+
+    updates = [{name + '_ci_low': None, name + '_ci_high': None, name + '_bayes_factor': None} for _ in bundles]
+    for j, i in enumerate(top_rows):
+        if not math.isnan(low[j]):
+            updates[i][name + '_ci_low'] = float(low[j])
+            updates[i][name + '_ci_high'] = float(high[j])
+        if not math.isnan(factors[j]):
+            updates[i][name + '_bayes_factor'] = float(factors[j])
+        print "%s %s: %s=%g, %g%% CI [%g, %g], Bayes factor %s" % (
+            bundles[i][0].id, annotations[i].get('team', ''), name, annotations[i][name],
+            confidence * 100, low[j], high[j], 'best' if j == 0 else '%.2f' % factors[j])
+
+    return _store_annotation_updates(evaluation.id, bundles, annotations, updates, dry_run=dry_run)
+
 
 def create_leaderboard_table(name, columns, parent, evaluation, dry_run=False):
     if not dry_run:
@@ -288,13 +1269,7 @@ def create_leaderboard_table(name, columns, parent, evaluation, dry_run=False):
         update_leaderboard_table(schema.id, submission, annotations, dry_run)
 
 
-def update_leaderboard_table(leaderboard_table, submission, fields, dry_run=False):
-    """
-    Insert or update a record in a leaderboard table for a submission.
-
-    :param fields: a dictionary including all scoring statistics plus the team name for the submission.
-    """
-
+def _add_submission_fields(submission, fields):
     ## copy fields from submission
     ## fields should already contain scoring stats
     fields['objectId'] = submission.id
@@ -302,6 +1277,16 @@ def update_leaderboard_table(leaderboard_table, submission, fields, dry_run=Fals
     fields['entityId'] = submission.entityId
     fields['versionNumber'] = submission.versionNumber
     fields['name'] = submission.name
+    return fields
+
+
+def update_leaderboard_table(leaderboard_table, submission, fields, dry_run=False):
+    """
+    Insert or update a record in a leaderboard table for a submission.
+
+    :param fields: a dictionary including all scoring statistics plus the team name for the submission.
+    """
+    _add_submission_fields(submission, fields)
 
     results = syn.tableQuery("select * from %s where objectId=%s" % (leaderboard_table, submission.id), resultsAs="rowset")
     rowset = results.asRowSet()
@@ -327,21 +1312,174 @@ def update_leaderboard_table(leaderboard_table, submission, fields, dry_run=Fals
         return syn.store(rowset)
 
 
-def query(evaluation, columns, out=sys.stdout):
-    """Test the query that will be run to construct the leaderboard"""
+class LeaderboardTableWriter(object):
+    """
+    Inserts or updates records in a leaderboard table for many submissions.
 
-    if type(evaluation) != Evaluation:
-        evaluation = syn.getEvaluation(evaluation)
+    The rows already in the table are indexed by objectId with a single query,
+    then inserts and updates are collected and stored as RowSets of up to
+    chunk_size rows, rather than querying and storing once per submission.
+    Call commit() to store any rows still pending.
+    """
+    def __init__(self, leaderboard_table, chunk_size=LEADERBOARD_CHUNK_SIZE):
+        self.leaderboard_table = leaderboard_table
+        self.chunk_size = chunk_size
+        self.headers = None
+        self.etag = None
+        self.index = None
+        self.pending = OrderedDict()
+
+    def _load_index(self):
+        ## rows are written with every column of the table, but only the
+        ## objectId of the existing rows is needed to index them
+        self.headers = [SelectColumn(id=column['id'], name=column['name'], columnType=column['columnType'])
+                        for column in syn.getTableColumns(self.leaderboard_table)]
+        rowset = syn.tableQuery("select objectId from %s" % self.leaderboard_table, resultsAs="rowset").asRowSet()
+        self.etag = rowset.get('etag', None)
+        i = [col['name'] for col in rowset['headers']].index('objectId')
+        self.index = {}
+        for row in rowset['rows']:
+            object_id = unicode(row['values'][i])
+            if object_id in self.index:
+                ## shouldn't happen
+                raise RuntimeError("Multiple entries in leaderboard table %s for submission %s" % (self.leaderboard_table, object_id))
+            self.index[object_id] = (row['rowId'], row.get('versionNumber', None))
+
+    def add(self, submission, fields):
+        """
+        :param fields: a dictionary including all scoring statistics plus the team name for the submission.
+        """
+        if self.index is None:
+            self._load_index()
+        _add_submission_fields(submission, fields)
+
+        ## build list of fields in proper order according to headers
+        values = [fields.get(col['name'], None) for col in self.headers]
+        object_id = unicode(submission.id)
+        if object_id in self.index:
+            rowId, versionNumber = self.index[object_id]
+            self.pending[object_id] = Row(values, rowId=rowId, versionNumber=versionNumber)
+        else:
+            self.pending[object_id] = Row(values)
+
+        if len(self.pending) >= self.chunk_size:
+            self.commit()
+
+    def commit(self):
+        while self.pending:
+            object_ids = list(self.pending.keys())[:self.chunk_size]
+            rows = [self.pending[object_id] for object_id in object_ids]
+            rowset = RowSet(headers=self.headers, tableId=self.leaderboard_table, etag=self.etag, rows=rows)
+            response = syn.store(rowset)
+
+            ## remember the IDs of new rows, so a submission scored twice in
+            ## one run gets updated rather than inserted twice
+            for object_id, ref in izip(object_ids, response.get('rows', [])):
+                self.index[object_id] = (ref['rowId'], ref.get('versionNumber', None))
+            for object_id in object_ids:
+                del self.pending[object_id]
+            self.etag = response.get('etag', self.etag)
+            print "stored %d rows in leaderboard table %s" % (len(rows), self.leaderboard_table)
+
+
+def _leaderboard_query(evaluation, names, where):
+    ## Select just the named columns, unless the query service objects to
+    ## some of them, in which case fall back to all columns.
+    leaderboard_query = "select * from evaluation_%s where %s" % (evaluation.id, where)
+    try:
+        return Query(query=leaderboard_query, columns=names)
+    except SynapseHTTPError as err:
+        if err.response is None or err.response.status_code != 400:
+            raise
+        return Query(query=leaderboard_query)
+
+
+def update_leaderboard_snapshot(evaluation, columns, snapshot_path):
+    """
+    Bring a local snapshot of the SCORED rows of an evaluation up to date.
+    The snapshot remembers the latest modifiedOn it has seen, so only rows
+    modified since then, less a lookback window for rows the query index
+    hadn't caught up with last time, are fetched. Rows that are no longer
+    SCORED are dropped from the snapshot.
+
+    :param snapshot_path: a JSON file, created if it doesn't exist
+    :returns: (headers, rows) for all the SCORED rows in the snapshot
+    """
+    names = [column['name'] for column in columns]
+    for name in ('objectId', 'status', 'modifiedOn'):
+        if name not in names:
+            names.append(name)
+
+    snapshot = None
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path) as f:
+            snapshot = json.load(f)
+        if snapshot.get('evaluationId') != evaluation.id or snapshot.get('columns') != names:
+            print "Leaderboard snapshot %s is for different columns or evaluation, rebuilding it" % snapshot_path
+            snapshot = None
+
+    if snapshot:
+        ## rows seen again are replaced by objectId, so overlap is harmless
+        lookback = getattr(conf, 'SNAPSHOT_LOOKBACK_MINUTES', SNAPSHOT_LOOKBACK_MINUTES)*60*1000
+        results = _leaderboard_query(evaluation, names, "modifiedOn >= %d" % max(0, snapshot['watermark'] - lookback))
+    else:
+        snapshot = dict(evaluationId=evaluation.id, columns=names, watermark=0, headers=[], rows={})
+        results = _leaderboard_query(evaluation, names, "status==\"SCORED\"")
+
+    changed = 0
+    for values in results:
+        row = dict(izip(results.headers, values))
+        if row['status'] == 'SCORED':
+            snapshot['rows'][row['objectId']] = row
+        else:
+            snapshot['rows'].pop(row['objectId'], None)
+        snapshot['watermark'] = max(snapshot['watermark'], long(row['modifiedOn']))
+        changed += 1
+    snapshot['headers'] += [header for header in results.headers if header not in snapshot['headers']]
+    print "Fetched %d rows changed since the last leaderboard snapshot" % changed
+
+    ## write to a temp file and rename, so an interrupted run leaves the old snapshot
+    with open(snapshot_path + '.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.rename(snapshot_path + '.tmp', snapshot_path)
+
+    headers = snapshot['headers']
+    rows = [[row.get(header, None) for header in headers]
+            for row in sorted(snapshot['rows'].values(), key=lambda row: long(row['objectId']))]
+    return headers, rows
+
+
+def query(evaluation, columns, out=sys.stdout, snapshot=None, local=False):
+    """
+    Test the query that will be run to construct the leaderboard
 
-    ## Note: Constructing the index on which the query operates is an
-    ## asynchronous process, so we may need to wait a bit.
-    results = Query(query="select * from evaluation_%s where status==\"SCORED\"" % evaluation.id)
+    :param snapshot: optionally, a file in which to keep the leaderboard
+                     between runs, so only changed rows need to be fetched
+    :param local:    build the leaderboard from the local state store
+                     rather than querying Synapse
+    """
+
+    if local:
+        headers = [column['name'] for column in columns]
+        rows = [[fields.get(name, None) for name in headers]
+                for fields in state_store.leaderboard_rows(utils.id_of(evaluation))]
+    else:
+        if type(evaluation) != Evaluation:
+            evaluation = syn.getEvaluation(evaluation)
+
+        ## Note: Constructing the index on which the query operates is an
+        ## asynchronous process, so we may need to wait a bit.
+        if snapshot:
+            headers, rows = update_leaderboard_snapshot(evaluation, columns, snapshot)
+        else:
+            results = _leaderboard_query(evaluation, [column['name'] for column in columns], "status==\"SCORED\"")
+            headers, rows = results.headers, results
 
     ## annotate each column with it's position in the query results, if it's there
     cols = copy.deepcopy(columns)
     for column in cols:
-        if column['name'] in results.headers:
-            column['index'] = results.headers.index(column['name'])
+        if column['name'] in headers:
+            column['index'] = headers.index(column['name'])
     indices = [column['index'] for column in cols if 'index' in column]
     column_index = {column['index']:column for column in cols if 'index' in column}
 
@@ -355,21 +1493,51 @@ def query(evaluation, columns, out=sys.stdout):
 
     ## print leaderboard
     out.write(",".join([column['name'] for column in cols if 'index' in column]) + "\n")
-    for row in results:
+    for row in rows:
         out.write(",".join(column_to_string(row, column_index, i) for i in indices))
         out.write("\n")
 
 
-def list_submissions(evaluation, status=None, **kwargs):
-    if isinstance(evaluation, basestring):
-        evaluation = syn.getEvaluation(evaluation)
-    print '\n\nSubmissions for: %s %s' % (evaluation.id, evaluation.name.encode('utf-8'))
+def list_submissions(evaluation, status=None, local=False, **kwargs):
+    """
+    :param local: list submissions from the local state store rather than
+                  asking Synapse
+    """
+    if local:
+        print '\n\nSubmissions for: %s (local state store)' % utils.id_of(evaluation)
+        bundles = state_store.bundles(utils.id_of(evaluation), status=status)
+    else:
+        if isinstance(evaluation, basestring):
+            evaluation = syn.getEvaluation(evaluation)
+        print '\n\nSubmissions for: %s %s' % (evaluation.id, evaluation.name.encode('utf-8'))
+        bundles = submission_bundles(evaluation, status=status)
     print '-' * 60
 
-    for submission, status in syn.getSubmissionBundles(evaluation, status=status):
+    for submission, status in bundles:
         print submission.id, submission.createdOn, status.status, submission.name.encode('utf-8'), submission.userId
 
 
+def sync(evaluation):
+    """
+    Bring the local state store up to date with all the submissions to an
+    evaluation, reporting the ones that are new or have changed status.
+    """
+    evaluation_id = utils.id_of(evaluation)
+    print '\n\nSyncing state store with: %s' % evaluation_id
+    print '-' * 60
+
+    seen = []
+    changed = 0
+    for page in _bundle_pages(evaluation_id):
+        for (submission, status), is_changed in izip(page, state_store.record_bundles(page)):
+            seen.append(submission.id)
+            if is_changed:
+                changed += 1
+                print "changed:", submission.id, status.status
+    removed = state_store.remove_missing(evaluation_id, seen)
+    print "%d submissions, %d new or changed, %d removed" % (len(seen), changed, removed)
+
+
 def list_evaluations(project):
     print '\n\nEvaluations for project: ', utils.id_of(project)
     print '-' * 60
@@ -379,7 +1547,119 @@ def list_evaluations(project):
         print "Evaluation: %s" % evaluation.id, evaluation.name.encode('utf-8')
 
 
-def archive(evaluation, destination=None, name=None, query=None):
+class _ArchiveMember(object):
+    """
+    One independently compressed piece of an archive. Gzip members and zstd
+    frames can be concatenated into a single valid file, so compressing each
+    submission on its own lets an interrupted archive be cut back to the end
+    of the last complete member and continued.
+    """
+    def __init__(self, out, compression):
+        self.out = out
+        if compression == 'gz':
+            self.writer = gzip.GzipFile(filename='', mode='wb', fileobj=out)
+        elif compression == 'zst':
+            if zstandard is None:
+                raise ValueError("zstd compression requires the zstandard package")
+            compressor = zstandard.ZstdCompressor(threads=ARCHIVE_COMPRESSION_THREADS)
+            self.writer = compressor.stream_writer(out)
+        elif compression == 'none':
+            self.writer = None
+        else:
+            raise ValueError("Unknown compression: \"%s\"" % compression)
+        self.compression = compression
+
+    def write(self, data):
+        if self.writer is None:
+            self.out.write(data)
+        else:
+            self.writer.write(data)
+
+    def close(self):
+        if self.compression == 'gz':
+            self.writer.close()
+        elif self.compression == 'zst':
+            self.writer.flush(zstandard.FLUSH_FRAME)
+
+
+def _write_tar_member(out, arcname, path):
+    """Write a file to a tar stream: a header, the contents and padding"""
+    tarinfo = tarfile.TarInfo(arcname)
+    stat = os.stat(path)
+    tarinfo.size = stat.st_size
+    tarinfo.mtime = stat.st_mtime
+    out.write(tarinfo.tobuf(tarfile.GNU_FORMAT))
+    with open(path, 'rb') as f:
+        shutil.copyfileobj(f, out, 1024*1024)
+    remainder = tarinfo.size % tarfile.BLOCKSIZE
+    if remainder:
+        out.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+
+def _read_archive_checkpoint(path, settings):
+    """
+    Read the checkpoint of an interrupted archive.
+
+    :returns: the entries written after each complete submission, which hold
+              the sizes of the archive and metadata files at that point, or
+              None if there's nothing to resume
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        lines = f.read().splitlines()
+    try:
+        if not lines or json.loads(lines[0]) != settings:
+            return None
+    except ValueError:
+        return None
+    entries = []
+    for line in lines[1:]:
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            ## a line cut short by the interruption
+            break
+    return entries or None
+
+
+def _write_archive_checkpoint(log, object_id, out, metadata, **fields):
+    out.flush()
+    metadata.flush()
+    fields.update(objectId=object_id, archive=out.tell(), metadata=metadata.tell())
+    log.write(json.dumps(fields) + '\n')
+    log.flush()
+    os.fsync(log.fileno())
+
+
+def _file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _fetch_unless_archived(submission, blobs):
+    """Get a submission, only downloading its file if its content isn't in blobs"""
+    submission = syn.getSubmission(submission, downloadFile=False)
+    if prefetch.content_md5(submission) not in blobs:
+        submission = syn.getSubmission(submission)
+    return submission
+
+
+def _read_archive_manifest(path, evaluation_id):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get('evaluationId') != evaluation_id:
+            raise ValueError("Archive manifest %s is for evaluation %s" % (path, manifest.get('evaluationId')))
+        return manifest
+    return dict(evaluationId=evaluation_id, archives=[], submissions={}, blobs={})
+
+
+def archive(evaluation, destination=None, name=None, query=None, workdir=None,
+            threads=ARCHIVE_DOWNLOAD_THREADS, compression='gz', manifest=None):
     """
     Archive the submissions for the given evaluation queue and store them in the destination synapse folder.
 
@@ -387,40 +1667,265 @@ def archive(evaluation, destination=None, name=None, query=None):
     :param destination: a synapse folder or its ID
     :param query: a query that will return the desired submissions. At least the ID must be returned.
                   defaults to _select * from evaluation_[EVAL_ID] where status=="SCORED"_.
+    :param workdir: directory in which the archive is built, an archive
+                    interrupted before it's uploaded is resumed from here
+    :param threads: number of submission files to download at once
+    :param compression: 'gz', 'zst' or 'none'
+    :param manifest: a JSON file listing previously archived submissions. If
+                     given, only submissions missing from the manifest are
+                     archived, each file is stored once per content hash and
+                     the manifest is updated once the archive is stored.
     """
-    tempdir = tempfile.mkdtemp()
-    archive_dirname = 'submissions_%s' % utils.id_of(evaluation)
+    evaluation_id = utils.id_of(evaluation)
+    archive_dirname = 'submissions_%s' % evaluation_id
 
     if not query:
-        query = 'select * from evaluation_%s where status=="SCORED"' % utils.id_of(evaluation)
+        query = 'select * from evaluation_%s where status=="SCORED"' % evaluation_id
 
     ## for each submission, download it's associated file and write a line of metadata
     results = Query(query=query)
     if 'objectId' not in results.headers:
         raise ValueError("Can't find the required field \"objectId\" in the results of the query: \"{0}\"".format(query))
+    object_id_index = results.headers.index('objectId')
+
+    previous = _read_archive_manifest(manifest, evaluation_id)
     if not name:
-        name = 'submissions_%s.tgz' % utils.id_of(evaluation)
-    tar_path = os.path.join(tempdir, name)
+        ## deltas are numbered in the order they're made
+        suffix = '_%d' % (len(previous['archives']) + 1) if manifest else ''
+        name = 'submissions_%s%s%s' % (evaluation_id, suffix, ARCHIVE_EXTENSIONS[compression])
+    if not workdir:
+        workdir = os.path.join(os.getcwd(), 'archive_%s' % evaluation_id)
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    tar_path = os.path.join(workdir, name)
+    metadata_path = os.path.join(workdir, 'submission_metadata.csv')
+    manifest_path = os.path.join(workdir, 'manifest.json')
+    checkpoint_path = tar_path + '.checkpoint'
+
+    ## a checkpoint is only good for the same query, columns and compression
+    settings = {'query': query, 'headers': results.headers, 'compression': compression,
+                'manifest': manifest, 'archives': previous['archives']}
+    checkpoint = _read_archive_checkpoint(checkpoint_path, settings)
+
+    ## in a delta, the metadata names the archive holding each file
+    headers = results.headers + (['filename', 'archive'] if manifest else ['filename'])
+    archived = dict(previous['submissions'])
+    blobs = dict(previous['blobs'])
+
     print "creating tar at:", tar_path
-    print results.headers
-    with tarfile.open(tar_path, mode='w:gz') as archive:
-        with open(os.path.join(tempdir, 'submission_metadata.csv'), 'w') as f:
-            f.write( (','.join(hdr for hdr in (results.headers + ['filename'])) + '\n').encode('utf-8') )
-            for result in results:
-                ## retrieve file into cache and copy it to destination
-                submission = syn.getSubmission(result[results.headers.index('objectId')])
+    print headers
+    if checkpoint:
+        latest = checkpoint[-1]
+        for entry in checkpoint:
+            if entry['objectId'] is not None:
+                archived[entry['objectId']] = entry.get('md5', None)
+            if 'blob' in entry:
+                blobs[entry['md5']] = entry['blob']
+        print "resuming after %d archived submissions" % (len(checkpoint) - 1)
+        for path, size in ((tar_path, latest['archive']), (metadata_path, latest['metadata'])):
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+    else:
+        with open(checkpoint_path, 'w') as log:
+            log.write(json.dumps(settings) + '\n')
+        with open(metadata_path, 'wb') as f:
+            f.write( (','.join(hdr for hdr in headers) + '\n').encode('utf-8') )
+        open(tar_path, 'wb').close()
+
+    remaining = ((DictObject(id=result[object_id_index]), result) for result in results
+                 if result[object_id_index] not in archived)
+    fetch = (lambda submission: _fetch_unless_archived(submission, blobs)) if manifest else None
+    count = len(checkpoint) - 1 if checkpoint else 0
+
+    with open(tar_path, 'r+b') as out, open(metadata_path, 'r+b') as metadata, open(checkpoint_path, 'a') as log:
+        out.seek(0, os.SEEK_END)
+        metadata.seek(0, os.SEEK_END)
+        if not checkpoint:
+            _write_archive_checkpoint(log, None, out, metadata)
+
+        ## download pool feeding the tar writer in query order
+        for submission, result in prefetch.prefetch_submissions(syn, remaining, lookahead=threads, fetch=fetch, submit=_engine_submit()):
+            fields = {}
+            if manifest:
+                md5 = prefetch.content_md5(submission) or _file_md5(submission.filePath)
+                if md5 not in blobs:
+                    blobs[md5] = {'path': 'blobs/%s_%s' % (md5, os.path.basename(submission.filePath)), 'archive': name}
+                    fields['blob'] = blobs[md5]
+                    member = _ArchiveMember(out, compression)
+                    _write_tar_member(member, os.path.join(archive_dirname, blobs[md5]['path']), submission.filePath)
+                    member.close()
+                fields['md5'] = md5
+                extra = [blobs[md5]['path'], blobs[md5]['archive']]
+            else:
                 prefixed_filename = submission.id + "_" + os.path.basename(submission.filePath)
-                archive.add(submission.filePath, arcname=os.path.join(archive_dirname, prefixed_filename))
-                line = (','.join(unicode(item) for item in (result+[prefixed_filename]))).encode('utf-8')
-                print line
-                f.write(line + '\n')
-        archive.add(
-            name=os.path.join(tempdir, 'submission_metadata.csv'),
-            arcname=os.path.join(archive_dirname, 'submission_metadata.csv'))
+                member = _ArchiveMember(out, compression)
+                _write_tar_member(member, os.path.join(archive_dirname, prefixed_filename), submission.filePath)
+                member.close()
+                extra = [prefixed_filename]
+            line = (','.join(unicode(item) for item in (result+extra))).encode('utf-8')
+            print line
+            metadata.write(line + '\n')
+            archived[result[object_id_index]] = fields.get('md5', None)
+            _write_archive_checkpoint(log, result[object_id_index], out, metadata, **fields)
+            count += 1
+
+        if manifest and count == 0:
+            print "Nothing new to archive since", previous['archives'][-1] if previous['archives'] else "the manifest was started"
+        else:
+            ## the metadata and the end of archive marker go in a last member,
+            ## which is cut off again if we're interrupted before the upload
+            metadata.flush()
+            member = _ArchiveMember(out, compression)
+            _write_tar_member(member, os.path.join(archive_dirname, 'submission_metadata.csv'), metadata_path)
+            if manifest:
+                with open(manifest_path, 'w') as f:
+                    json.dump(dict(evaluationId=evaluation_id, archives=previous['archives'] + [name],
+                                   submissions=archived, blobs=blobs), f)
+                _write_tar_member(member, os.path.join(archive_dirname, 'manifest.json'), manifest_path)
+            member.write(tarfile.NUL * (2*tarfile.BLOCKSIZE))
+            member.close()
+
+    entity_id = None
+    if not manifest or count > 0:
+        ## large files are uploaded in parts by a pool of threads in the client
+        entity = syn.store(File(tar_path, parent=destination), evaluation_id=evaluation_id)
+        print "created:", entity.id, entity.name
+        entity_id = entity.id
+
+    ## the manifest only moves on once the archive is safely stored
+    if manifest and count > 0:
+        shutil.copy(manifest_path, manifest + '.tmp')
+        os.rename(manifest + '.tmp', manifest)
+
+    for path in (tar_path, metadata_path, checkpoint_path, manifest_path):
+        if os.path.exists(path):
+            os.remove(path)
+    if not os.listdir(workdir):
+        os.rmdir(workdir)
+    return entity_id
+
+
+def _report_error(context):
+    """Print the current exception and send it to the challenge admins"""
+    sys.stderr.write('Error in %s:\n' % context)
+    st = StringIO()
+    traceback.print_exc(file=st)
+    sys.stderr.write(st.getvalue())
+    sys.stderr.write('\n')
+
+    if conf.ADMIN_USER_IDS:
+        messages.error_notification(userIds=conf.ADMIN_USER_IDS, message=st.getvalue(), queue_name=conf.CHALLENGE_NAME)
+
+
+def _lease_interval():
+    return timedelta(seconds=getattr(conf, 'LEASE_HEARTBEAT_SECONDS', 30))
+
+
+def _queue_lease_name(step_name, evaluation_id):
+    return 'challenge_%s_%s' % (step_name, evaluation_id)
+
+
+def release_leases(leases):
+    for lease in leases:
+        if lease in queue_leases:
+            queue_leases.remove(lease)
+        lease.release()
+
+
+def acquire_queue_leases(evaluation_ids):
+    """
+    Take the validate and score leases on each of the given queues, so a
+    command that changes their submissions can't run while they're being
+    validated or scored.
+
+    :returns: the leases, to be given back with release_leases
+    :raises LockedException: if another process holds one of the leases,
+                             after giving back those already taken
+    """
+    leases = []
+    try:
+        for evaluation_id in OrderedDict.fromkeys(utils.id_of(evaluation) for evaluation in evaluation_ids):
+            for step_name in ('validate', 'score'):
+                leases.append(lock.acquire_lease_or_fail(_queue_lease_name(step_name, evaluation_id), interval=_lease_interval()))
+    except:
+        release_leases(leases)
+        raise
+    queue_leases.extend(leases)
+    return leases
+
+
+def run_leased(step, evaluation, **kwargs):
+    """
+    Run validate or score on an evaluation queue while holding the lease on
+    that step and queue, so other processes can work on other queues and
+    steps at the same time. If another process holds the lease, the queue is
+    skipped. When claiming submissions, each submission is guarded by its
+    claim, so no lease is needed. If the lease is lost, the step stops with
+    a LeaseLostException before storing another status.
+
+    :returns: the number of submissions processed
+    """
+    if kwargs.get('claim', False) and not kwargs.get('dry_run', False):
+        return step(evaluation, **kwargs)
+    name = _queue_lease_name(step.__name__, utils.id_of(evaluation))
+    try:
+        lease = lock.acquire_lease_or_fail(name, interval=_lease_interval())
+    except lock.LockedException as ex1:
+        print "Skipping %s of %s: %s" % (step.__name__, utils.id_of(evaluation), ex1)
+        return 0
+    queue_leases.append(lease)
+    try:
+        return step(evaluation, **kwargs)
+    finally:
+        release_leases([lease])
+
+
+def serve(min_interval=SERVE_MIN_INTERVAL, max_interval=SERVE_MAX_INTERVAL, **kwargs):
+    """
+    Repeatedly validate and score all evaluation queues in the challenge,
+    reusing one Synapse connection and its caches.
 
-    entity = syn.store(File(tar_path, parent=destination), evaluation_id=utils.id_of(evaluation))
-    print "created:", entity.id, entity.name
-    return entity.id
+    After a pass in which submissions were processed, the next pass starts
+    after min_interval seconds. Each idle pass doubles the wait, up to
+    max_interval seconds. On SIGTERM, the current step is allowed to finish
+    and the loop exits.
+
+    :param kwargs: options for validate and score
+    """
+    stopping = []
+    def stop(signum, frame):
+        print "\nReceived signal %d, stopping after the current step" % signum
+        stopping.append(signum)
+    previous_handler = signal.signal(signal.SIGTERM, stop)
+
+    try:
+        evaluations = [syn.getEvaluation(queue_info['id']) for queue_info in conf.evaluation_queues]
+        interval = min_interval
+        while not stopping:
+            print "\n", datetime.utcnow().isoformat(), "polling %d queues" % len(evaluations)
+
+            ## a failing queue or step is reported and skipped, so it
+            ## can't hold up the others
+            processed = 0
+            for evaluation in evaluations:
+                for step in (validate, score):
+                    if stopping:
+                        break
+                    try:
+                        processed += run_leased(step, evaluation, **kwargs)
+                    except Exception:
+                        _report_error('scoring daemon, %s of %s' % (step.__name__, evaluation.id))
+
+            interval = min_interval if processed else min(max_interval, interval*2)
+            print "processed %d submissions, next poll in %d seconds" % (processed, interval)
+            sys.stdout.flush()
+
+            ## sleep in short steps so we notice SIGTERM promptly
+            wake = time.time() + interval
+            while not stopping and time.time() < wake:
+                time.sleep(min(1, wake - time.time()))
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
 
 
 ## ==================================================
@@ -435,17 +1940,28 @@ def command_list(args):
     if args.all:
         for queue_info in conf.evaluation_queues:
             list_submissions(evaluation=queue_info['id'],
-                             status=args.status)
+                             status=args.status,
+                             local=args.local)
     elif args.challenge_project:
         list_evaluations(project=args.challenge_project)
     elif args.evaluation:
         list_submissions(evaluation=args.evaluation,
-                         status=args.status)
+                         status=args.status,
+                         local=args.local)
     else:
         list_evaluations(project=conf.CHALLENGE_SYN_ID)
 
 
 def command_check_status(args):
+    if args.local:
+        bundle = state_store.get(args.submission)
+        if bundle is None:
+            sys.stderr.write("\nSubmission %s isn't in the local state store\n" % args.submission)
+            return
+        for obj in bundle:
+            print unicode(obj).encode('utf-8')
+        return
+
     submission = syn.getSubmission(args.submission)
     status = syn.getSubmissionStatus(args.submission)
     evaluation = syn.getEvaluation(submission.evaluationId)
@@ -458,12 +1974,31 @@ def command_check_status(args):
 
 
 def command_reset(args):
+    ## keep validate and score off the queues while we reset them
+    if args.rescore_all:
+        queue_ids = [queue_info['id'] for queue_info in conf.evaluation_queues]
+    elif args.rescore:
+        queue_ids = args.rescore
+    else:
+        queue_ids = [syn.getSubmission(submission, downloadFile=False).evaluationId for submission in args.submission]
+    try:
+        leases = [] if args.dry_run else acquire_queue_leases(queue_ids)
+    except lock.LockedException as ex1:
+        sys.stderr.write("\nCan't reset submissions while their queues are being validated or scored: %s\n" % ex1)
+        return
+    try:
+        _reset(args)
+    finally:
+        release_leases(leases)
+
+
+def _reset(args):
     if args.rescore_all:
         for queue_info in conf.evaluation_queues:
             for submission, status in syn.getSubmissionBundles(queue_info['id'], status="SCORED"):
                 status.status = args.status
                 if not args.dry_run:
-                    print unicode(syn.store(status)).encode('utf-8')
+                    print unicode(store_status(status)).encode('utf-8')
     elif args.rescore:
         for queue_id in args.rescore:
             for submission, status in syn.getSubmissionBundles(queue_id, status="SCORED"):
@@ -478,15 +2013,26 @@ def command_reset(args):
             status = syn.getSubmissionStatus(submission)
             status.status = args.status
             if not args.dry_run:
-                print unicode(syn.store(status)).encode('utf-8')
+                print unicode(store_status(status)).encode('utf-8')
+
+
+def _processing_options(args):
+    """Options shared by the validate and score commands"""
+    return dict(dry_run=args.dry_run,
+                workers=args.workers,
+                prefetch_count=args.prefetch,
+                prefetch_bytes=args.prefetch_bytes,
+                batch_commit=args.batch_commit,
+                claim=args.claim,
+                policy=args.schedule)
 
 
 def command_validate(args):
     if args.all:
         for queue_info in conf.evaluation_queues:
-            validate(queue_info['id'], dry_run=args.dry_run)
+            run_leased(validate, queue_info['id'], **_processing_options(args))
     elif args.evaluation:
-        validate(args.evaluation, dry_run=args.dry_run)
+        run_leased(validate, args.evaluation, **_processing_options(args))
     else:
         sys.stderr.write("\nValidate command requires either an evaluation ID or --all to validate all queues in the challenge")
 
@@ -494,15 +2040,48 @@ def command_validate(args):
 def command_score(args):
     if args.all:
         for queue_info in conf.evaluation_queues:
-            score(queue_info['id'], dry_run=args.dry_run)
+            run_leased(score, queue_info['id'], **_processing_options(args))
     elif args.evaluation:
-        score(args.evaluation, dry_run=args.dry_run)
+        run_leased(score, args.evaluation, **_processing_options(args))
     else:
         sys.stderr.write("\Score command requires either an evaluation ID or --all to score all queues in the challenge")
 
 
+def command_sync(args):
+    if args.all:
+        for queue_info in conf.evaluation_queues:
+            sync(queue_info['id'])
+    elif args.evaluation:
+        sync(args.evaluation)
+    else:
+        sys.stderr.write("\nSync command requires either an evaluation ID or --all to sync all queues in the challenge")
+
+
+def command_serve(args):
+    serve(min_interval=args.min_interval, max_interval=args.max_interval, **_processing_options(args))
+
+
 def command_rank(args):
-    raise NotImplementedError('Implement a ranking function for your challenge')
+    if args.all:
+        for queue_info in conf.evaluation_queues:
+            rank(queue_info['id'], dry_run=args.dry_run)
+    elif args.evaluation:
+        rank(args.evaluation, dry_run=args.dry_run)
+    else:
+        sys.stderr.write("\nRank command requires either an evaluation ID or --all to rank all queues in the challenge")
+
+
+def command_significance(args):
+    options = dict(dry_run=args.dry_run, top=args.top, resamples=args.resamples,
+                   confidence=args.confidence, processes=args.processes, seed=args.seed)
+    if args.all:
+        for queue_info in conf.evaluation_queues:
+            if queue_info['id'] in getattr(conf, 'significance_tests', {}):
+                significance(queue_info['id'], **options)
+    elif args.evaluation:
+        significance(args.evaluation, **options)
+    else:
+        sys.stderr.write("\nSignificance command requires either an evaluation ID or --all to test all queues in the challenge")
 
 
 def command_leaderboard(args):
@@ -512,14 +2091,25 @@ def command_leaderboard(args):
     ## write out to file if --out args given
     if args.out is not None:
         with open(args.out, 'w') as f:
-            query(args.evaluation, columns=leaderboard_cols, out=f)
+            query(args.evaluation, columns=leaderboard_cols, out=f, snapshot=args.snapshot, local=args.local)
         print "Wrote leaderboard out to:", args.out
     else:
-        query(args.evaluation, columns=leaderboard_cols)
+        query(args.evaluation, columns=leaderboard_cols, snapshot=args.snapshot, local=args.local)
 
 
 def command_archive(args):
-    archive(args.evaluation, args.destination, name=args.name, query=args.query)
+    ## archive a consistent set of submissions, not one being scored
+    try:
+        leases = acquire_queue_leases([args.evaluation])
+    except lock.LockedException as ex1:
+        sys.stderr.write("\nCan't archive while the queue is being validated or scored: %s\n" % ex1)
+        return
+    try:
+        archive(args.evaluation, args.destination, name=args.name, query=args.query,
+                workdir=args.workdir, threads=args.threads, compression=args.compression,
+                manifest=args.manifest)
+    finally:
+        release_leases(leases)
 
 
 ## ==================================================
@@ -531,7 +2121,7 @@ def main():
     if conf.CHALLENGE_SYN_ID == "":
         sys.stderr.write("Please configure your challenge. See sample_challenge.py for an example.")
 
-    global syn
+    global syn, name_cache, update_lock, state_store, result_cache, synapse_io
 
     parser = argparse.ArgumentParser()
 
@@ -542,6 +2132,10 @@ def main():
     parser.add_argument("--acknowledge-receipt", help="Send confirmation message on passing validation to participants", action="store_true", default=False)
     parser.add_argument("--dry-run", help="Perform the requested command without updating anything in Synapse", action="store_true", default=False)
     parser.add_argument("--debug", help="Show verbose error output from Synapse API calls", action="store_true", default=False)
+    parser.add_argument("--state-db", metavar="FILE", help="Mirror submissions and their statuses in this local SQLite file", default=getattr(conf, 'STATE_DB_FILE', None))
+    parser.add_argument("--max-requests", metavar="N", type=int, help="Number of Synapse requests to keep in flight over pooled connections, by default 0 to make one request at a time", default=getattr(conf, 'MAX_REQUESTS_IN_FLIGHT', 0))
+    parser.add_argument("--outbox", metavar="FILE", help="Send messages in the background, queued in this SQLite file", default=getattr(conf, 'MESSAGE_OUTBOX_FILE', None))
+    parser.add_argument("--result-cache", metavar="FILE", help="Reuse validation and scoring results for identical files, kept in this SQLite file", default=getattr(conf, 'RESULT_CACHE_FILE', None))
 
     subparsers = parser.add_subparsers(title="subcommand")
 
@@ -550,10 +2144,12 @@ def main():
     parser_list.add_argument("--challenge-project", "--challenge", "--project", metavar="SYNAPSE-ID", default=None)
     parser_list.add_argument("-s", "--status", default=None)
     parser_list.add_argument("--all", action="store_true", default=False)
+    parser_list.add_argument("--local", action="store_true", default=False, help="List submissions from the local state store")
     parser_list.set_defaults(func=command_list)
 
     parser_status = subparsers.add_parser('status', help="Check the status of a submission")
     parser_status.add_argument("submission")
+    parser_status.add_argument("--local", action="store_true", default=False, help="Show the submission as recorded in the local state store")
     parser_status.set_defaults(func=command_check_status)
 
     parser_reset = subparsers.add_parser('reset', help="Reset a submission to RECEIVED for re-scoring (or set to some other status)")
@@ -566,42 +2162,89 @@ def main():
     parser_validate = subparsers.add_parser('validate', help="Validate all RECEIVED submissions to an evaluation")
     parser_validate.add_argument("evaluation", metavar="EVALUATION-ID", nargs='?', default=None, )
     parser_validate.add_argument("--all", action="store_true", default=False)
+    parser_validate.add_argument("--workers", metavar="N", type=int, default=1, help="Number of submissions to validate concurrently")
     parser_validate.set_defaults(func=command_validate)
 
     parser_score = subparsers.add_parser('score', help="Score all VALIDATED submissions to an evaluation")
     parser_score.add_argument("evaluation", metavar="EVALUATION-ID", nargs='?', default=None)
     parser_score.add_argument("--all", action="store_true", default=False)
+    parser_score.add_argument("--workers", metavar="N", type=int, default=1, help="Number of processes to run the scoring function in")
     parser_score.set_defaults(func=command_score)
 
+    parser_sync = subparsers.add_parser('sync', help="Update the local state store with all submissions to an evaluation")
+    parser_sync.add_argument("evaluation", metavar="EVALUATION-ID", nargs='?', default=None)
+    parser_sync.add_argument("--all", action="store_true", default=False)
+    parser_sync.set_defaults(func=command_sync)
+
+    parser_serve = subparsers.add_parser('serve', help="Keep validating and scoring all evaluation queues until stopped")
+    parser_serve.add_argument("--min-interval", metavar="SECONDS", type=int, default=SERVE_MIN_INTERVAL, help="Seconds between polls while there are submissions to process")
+    parser_serve.add_argument("--max-interval", metavar="SECONDS", type=int, default=SERVE_MAX_INTERVAL, help="Longest wait between polls while the queues are idle")
+    parser_serve.add_argument("--workers", metavar="N", type=int, default=1, help="Number of submissions to validate or score concurrently")
+    parser_serve.set_defaults(func=command_serve)
+
+    for subparser in (parser_validate, parser_score, parser_serve):
+        subparser.add_argument("--prefetch", metavar="N", type=int, default=None, help="Number of submission files to download ahead of validation or scoring, by default one per worker")
+        subparser.add_argument("--prefetch-bytes", metavar="BYTES", type=int, default=prefetch.DEFAULT_PREFETCH_BYTES, help="Limit on the total size of files downloaded ahead or waiting for a worker")
+        subparser.add_argument("--batch-commit", action="store_true", default=False, help="Store submission statuses in batches")
+        subparser.add_argument("--schedule", choices=schedule.POLICIES, default=getattr(conf, 'SCHEDULING_POLICY', 'fifo'), help="Order in which to work on waiting submissions: as listed, smallest file first, round robin across teams or oldest first")
+        subparser.add_argument("--claim", action="store_true", default=False, help="Claim each submission before working on it, so several hosts can share a queue")
+
     parser_rank = subparsers.add_parser('rank', help="Rank all SCORED submissions to an evaluation")
-    parser_rank.add_argument("evaluation", metavar="EVALUATION-ID", default=None)
+    parser_rank.add_argument("evaluation", metavar="EVALUATION-ID", nargs='?', default=None)
+    parser_rank.add_argument("--all", action="store_true", default=False)
     parser_rank.set_defaults(func=command_rank)
 
+    parser_significance = subparsers.add_parser('significance', help="Bootstrap confidence intervals and Bayes factors for the top submissions to an evaluation")
+    parser_significance.add_argument("evaluation", metavar="EVALUATION-ID", nargs='?', default=None)
+    parser_significance.add_argument("--all", action="store_true", default=False)
+    parser_significance.add_argument("--top", metavar="N", type=int, default=None, help="Number of top scoring submissions to test")
+    parser_significance.add_argument("--resamples", metavar="N", type=int, default=None, help="Number of bootstrap resamples")
+    parser_significance.add_argument("--confidence", metavar="LEVEL", type=float, default=None, help="Confidence level of the intervals, 0.95 by default")
+    parser_significance.add_argument("--processes", metavar="N", type=int, default=multiprocessing.cpu_count(), help="Number of processes to evaluate resamples in")
+    parser_significance.add_argument("--seed", type=int, default=None, help="Seed for drawing resamples, for reproducible results")
+    parser_significance.set_defaults(func=command_significance)
+
     parser_archive = subparsers.add_parser('archive', help="Archive submissions to a challenge")
     parser_archive.add_argument("evaluation", metavar="EVALUATION-ID", default=None)
     parser_archive.add_argument("destination", metavar="FOLDER-ID", default=None)
     parser_archive.add_argument("-q", "--query", default=None)
     parser_archive.add_argument("-n", "--name", default=None)
+    parser_archive.add_argument("--threads", type=int, default=ARCHIVE_DOWNLOAD_THREADS,
+        help="Number of submission files to download at once")
+    parser_archive.add_argument("--compression", choices=sorted(ARCHIVE_EXTENSIONS), default='gz',
+        help="Compression of the archive, zst requires the zstandard package")
+    parser_archive.add_argument("--workdir", default=None,
+        help="Directory in which to build the archive, an interrupted archive resumes from here")
+    parser_archive.add_argument("--manifest", default=None,
+        help="JSON file of previously archived submissions, only newer submissions are archived")
     parser_archive.set_defaults(func=command_archive)
 
     parser_leaderboard = subparsers.add_parser('leaderboard', help="Print the leaderboard for an evaluation")
     parser_leaderboard.add_argument("evaluation", metavar="EVALUATION-ID", default=None)
     parser_leaderboard.add_argument("--out", default=None)
+    parser_leaderboard.add_argument("--local", action="store_true", default=False, help="Build the leaderboard from the local state store")
+    parser_leaderboard.add_argument("--snapshot", metavar="FILE", default=None, help="Keep the leaderboard in this file between runs and fetch only rows changed since")
     parser_leaderboard.set_defaults(func=command_leaderboard)
 
     args = parser.parse_args()
 
+    if getattr(args, 'local', False) or args.func == command_sync:
+        if not args.state_db:
+            parser.error("a local state store is needed, give one with --state-db or STATE_DB_FILE in challenge_config")
+
     print "\n" * 2, "=" * 75
     print datetime.utcnow().isoformat()
 
-    ## Acquire lock, don't run two scoring scripts at once
-    try:
-        update_lock = lock.acquire_lock_or_fail('challenge', max_age=timedelta(hours=4))
-    except lock.LockedException:
-        print u"Is the scoring script already running? Can't acquire lock."
-        # can't acquire lock, so return error code 75 which is a
-        # temporary error according to /usr/include/sysexits.h
-        return 75
+    ## Acquire lock, don't run two scoring scripts at once. Validate, score
+    ## and serve instead take a lease on each queue and step as they go.
+    if args.func not in (command_validate, command_score, command_serve):
+        try:
+            update_lock = lock.acquire_lease_or_fail('challenge', interval=_lease_interval())
+        except lock.LockedException:
+            print u"Is the scoring script already running? Can't acquire lock."
+            # can't acquire lock, so return error code 75 which is a
+            # temporary error according to /usr/include/sysexits.h
+            return 75
 
     try:
         syn = synapseclient.Synapse(debug=args.debug)
@@ -609,7 +2252,26 @@ def main():
             args.user = os.environ.get('SYNAPSE_USER', None)
         if not args.password:
             args.password = os.environ.get('SYNAPSE_PASSWORD', None)
-        syn.login(email=args.user, password=args.password)
+        ## answering from the local state store doesn't need a login
+        if not getattr(args, 'local', False):
+            syn.login(email=args.user, password=args.password)
+
+        if args.max_requests > 0:
+            synapse_io = synio.SynapseIO(syn, max_in_flight=args.max_requests,
+                                         endpoint_limits=getattr(conf, 'ENDPOINT_LIMITS', None))
+            synapse_io.install()
+
+        ## cache participant names between runs
+        name_cache = cache.PersistentCache(
+            path=getattr(conf, 'NAME_CACHE_FILE', None),
+            ttl=timedelta(hours=getattr(conf, 'NAME_CACHE_TTL_HOURS', 24)),
+            max_entries=getattr(conf, 'NAME_CACHE_MAX_ENTRIES', 10000))
+
+        if args.state_db:
+            state_store = statestore.StateStore(args.state_db)
+
+        if args.result_cache:
+            result_cache = cache.PersistentCache(path=args.result_cache)
 
         ## initialize messages
         messages.syn = syn
@@ -617,21 +2279,30 @@ def main():
         messages.send_messages = args.send_messages
         messages.send_notifications = args.notifications
         messages.acknowledge_receipt = args.acknowledge_receipt
+        if args.outbox and not args.dry_run:
+            messages.outbox = outbox.Outbox(
+                syn, args.outbox,
+                max_rate=getattr(conf, 'MESSAGES_PER_SECOND', 1.0),
+                max_attempts=getattr(conf, 'MESSAGE_MAX_ATTEMPTS', 5),
+                digest_interval=getattr(conf, 'NOTIFICATION_DIGEST_MINUTES', 10)*60)
 
         args.func(args)
 
-    except Exception as ex1:
-        sys.stderr.write('Error in scoring script:\n')
-        st = StringIO()
-        traceback.print_exc(file=st)
-        sys.stderr.write(st.getvalue())
-        sys.stderr.write('\n')
-
-        if conf.ADMIN_USER_IDS:
-            messages.error_notification(userIds=conf.ADMIN_USER_IDS, message=st.getvalue(), queue_name=conf.CHALLENGE_NAME)
+    except Exception:
+        _report_error('scoring script')
 
     finally:
-        update_lock.release()
+        name_cache.close()
+        if state_store:
+            state_store.close()
+        if result_cache:
+            result_cache.close()
+        if messages.outbox:
+            messages.outbox.close()
+        if synapse_io:
+            synapse_io.close()
+        if update_lock:
+            update_lock.release()
 
     print "\ndone: ", datetime.utcnow().isoformat()
     print "=" * 75, "\n" * 2
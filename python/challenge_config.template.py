@@ -28,7 +28,9 @@ ADMIN_USER_IDS = []
 ## ...and found like this:
 ##   evaluations = list(syn.getEvaluationByContentSource('syn3375314'))
 ## Configuring them here as a list will save a round-trip to the server
-## every time the script starts.
+## every time the script starts. A queue can also give the path of its
+## gold standard as goldstandard_path, for read_goldstandard, like so:
+##   evaluation_queues = [dict(id="9614112", name="My Challenge Q1", goldstandard_path="q1_truth.txt")]
 evaluation_queues = []
 evaluation_queue_by_id = {q['id']:q for q in evaluation_queues}
 
@@ -44,17 +46,125 @@ LEADERBOARD_COLUMNS = [
 ## Here we're adding columns for the output of our scoring functions, score,
 ## rmse and auc to the basic leaderboard information. In general, different
 ## questions would typically have different scoring metrics.
+##
+## A column can name the metric it holds from metrics.py with a 'metric'
+## key: one of rmse, pearson, spearman, auroc, aupr, cindex or macro_f1.
+## metrics.score_columns computes all of a queue's named metrics, and the
+## significance command uses a column's metric by default.
+##
+## The rank command ranks submissions by each column with a 'rank' key,
+## 'descending' if higher is better or 'ascending' if lower is better. The
+## optional 'rank_ties' key is one of 'min' (the default), 'max', 'average',
+## 'dense' or 'ordinal'. Each submission is annotated with [name]_rank,
+## [name]_team_rank and [name]_team_best, ranking teams by their best
+## submission. Ranking requires numpy.
 leaderboard_columns = {}
 for q in evaluation_queues:
     leaderboard_columns[q['id']] = LEADERBOARD_COLUMNS + [
-        dict(name='score',         display_name='Score',   columnType='DOUBLE'),
-        dict(name='rmse',          display_name='RMSE',    columnType='DOUBLE'),
-        dict(name='auc',           display_name='AUC',     columnType='DOUBLE')]
+        dict(name='score',         display_name='Score',   columnType='DOUBLE', rank='descending'),
+        dict(name='rmse',          display_name='RMSE',    columnType='DOUBLE', rank='ascending', metric='rmse'),
+        dict(name='auc',           display_name='AUC',     columnType='DOUBLE', rank='descending', metric='auroc')]
 
 ## map each evaluation queues to the synapse ID of a table object
 ## where the table holds a leaderboard for that question
 leaderboard_tables = {}
 
+## Participant and team names are cached in this file between runs of the
+## scoring script, so we don't have to look up the same people every time.
+## Set to None to cache names only for the duration of a run.
+NAME_CACHE_FILE = "challenge_cache.db"
+NAME_CACHE_TTL_HOURS = 24
+NAME_CACHE_MAX_ENTRIES = 10000
+
+## Optionally, mirror submissions and their statuses in a local SQLite file,
+## which lets the list, status and leaderboard commands answer with --local
+## without asking Synapse. Keep it up to date with the sync command.
+STATE_DB_FILE = None
+
+## Optionally, keep the results of validate_submission and score_submission
+## in a SQLite file, keyed by the MD5 of the submitted file, so identical
+## files aren't validated or scored twice. Change the version tags whenever
+## the validation or scoring code changes, to stop reusing old results.
+RESULT_CACHE_FILE = None
+VALIDATION_FUNCTION_VERSION = "1"
+SCORING_FUNCTION_VERSION = "1"
+
+## Optionally, queue messages in a SQLite file and send them from a
+## background thread, at most MESSAGES_PER_SECOND, retrying failures. Error
+## notifications to admins are collected into a digest every
+## NOTIFICATION_DIGEST_MINUTES.
+MESSAGE_OUTBOX_FILE = None
+MESSAGES_PER_SECOND = 1.0
+MESSAGE_MAX_ATTEMPTS = 5
+NOTIFICATION_DIGEST_MINUTES = 10
+
+## Set MAX_REQUESTS_IN_FLIGHT to have Synapse requests share a pool of
+## keep-alive connections, with up to this many in flight at once, say 32.
+## 0 makes one request at a time. Requests to the endpoints listed in
+## ENDPOINT_LIMITS are further limited, for example
+## ENDPOINT_LIMITS = {'/evaluation/submission/query': 4, '/message': 2}
+MAX_REQUESTS_IN_FLIGHT = 0
+ENDPOINT_LIMITS = {}
+
+## Validate and score take a lease on each queue they work on, renewed every
+## LEASE_HEARTBEAT_SECONDS. A lease is broken when its holder has missed a
+## few heartbeats, meaning the holder has died or hung.
+LEASE_HEARTBEAT_SECONDS = 30
+
+## With --claim, several hosts can validate and score the same queue. Each
+## claims a submission before working on it. A claim not finished within
+## CLAIM_TTL_MINUTES is taken to be abandoned and the submission is picked
+## up again, so this should be longer than the slowest scoring run.
+CLAIM_TTL_MINUTES = 60
+
+## Optionally run the validation and scoring functions for a queue in a
+## child process with limits on wall clock time and CPU time in seconds and
+## memory in bytes. A submission that goes over a limit is marked INVALID
+## by validation or gets a scoring error. Validating with --workers needs a
+## wall_time, as a child forked from one of several threads can hang on a
+## lock another thread held. For example:
+## sandbox_limits = {"9614112": dict(wall_time=600, cpu_time=600, memory=4*1024**3)}
+sandbox_limits = {}
+
+## With score --workers, a submission whose worker hasn't returned a score
+## within this many seconds, because it hung or was killed, gets a scoring
+## error and the workers are restarted. A queue's sandbox wall_time, plus a
+## minute, takes precedence.
+SCORING_TIMEOUT_SECONDS = 6*60*60
+
+## The order in which to validate and score waiting submissions: "fifo" as
+## listed by Synapse, "sjf" smallest file first, "fair" round robin across
+## teams and users or "oldest" first. Override with --schedule.
+SCHEDULING_POLICY = "fifo"
+
+## Optionally check the files submitted to a queue against a schema before
+## calling validate_submission, reading them as a stream so big files are
+## checked in little memory. See filevalidator.py for all the options, and
+## bump VALIDATION_FUNCTION_VERSION when a schema changes. For example:
+## submission_schemas = {"9614112": dict(
+##     columns=[dict(name='id', type='string'),
+##              dict(name='prediction', type='float', min=0, max=1)],
+##     id_column='id', ids='q1_ids.txt', max_errors=10)}
+submission_schemas = {}
+
+## The significance command computes bootstrap confidence intervals for the
+## top submissions to a queue and Bayes factors comparing each to the best,
+## stored as [column]_ci_low, [column]_ci_high and [column]_bayes_factor
+## annotations. Add columns by those names to leaderboard_columns to show
+## them. The metric is the column's metric from leaderboard_columns unless
+## given here, by name or as a function, which is evaluated on many
+## resamples at once: it takes the resampled gold standard and predictions
+## as numpy arrays of shape (resamples, n) and returns an array of shape
+## (resamples,), as the functions in metrics.py do. For example:
+## significance_tests = {"9614112": dict(column='auc', top=10, resamples=1000)}
+significance_tests = {}
+
+## Gold standard files read with read_goldstandard are parsed once and kept
+## here as memory-mappable .npy files, named by the MD5 of the original.
+## The gold standards of queues with a goldstandard_path are loaded before
+## worker processes are started, which then share the memory map.
+GOLDSTANDARD_CACHE_DIR = "goldstandard_cache"
+
 
 def validate_submission(evaluation, submission):
     """
@@ -68,7 +178,11 @@ def validate_submission(evaluation, submission):
 
 def score_submission(evaluation, submission):
     """
-    Find the right scoring function and score the submission
+    Find the right scoring function and score the submission. To compute
+    the metrics named in leaderboard_columns:
+        import metrics
+        scores = metrics.score_columns(leaderboard_columns[evaluation.id],
+            read_goldstandard(evaluation), read_predictions(evaluation, submission))
 
     :returns: (score, message) where score is a dict of stats and message
               is text for display to user
@@ -77,3 +191,25 @@ def score_submission(evaluation, submission):
     return (dict(score=random.random(), rmse=random.random(), auc=random.random()), "You did fine!")
 
 
+def read_goldstandard(evaluation):
+    """
+    Read the gold standard of a question, named by the goldstandard_path of
+    its queue in evaluation_queues. The file is parsed once, then memory
+    mapped, so call this from scoring and validation functions freely. Pass
+    a parse function to goldstandard.load for other formats than text.
+
+    :returns: a read-only numpy array of values
+    """
+    import goldstandard
+    return goldstandard.load(evaluation_queue_by_id[evaluation.id]['goldstandard_path'],
+                             cache_dir=GOLDSTANDARD_CACHE_DIR)
+
+
+def read_predictions(evaluation, submission):
+    """
+    Read a submission's predictions for significance testing.
+
+    :returns: a numpy array of values in the same order as the gold standard
+    """
+    import numpy
+    return numpy.loadtxt(submission.filePath)
@@ -1,5 +1,6 @@
 # Automation of validation and scoring
 # Make sure you point to the directory where challenge.py belongs and a log directory must exist for the output
+# Alternatively, skip cron and run "python challenge.py serve" to poll the queues continuously
 cd ./
 #---------------------
 #Validate submissions
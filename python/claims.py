@@ -0,0 +1,105 @@
+## Claim submissions before working on them, so that several machines can
+## validate and score the same evaluation queue without doing the same
+## submission twice.
+##
+## A worker claims a submission by moving its status to
+## EVALUATION_IN_PROGRESS, annotated with the step, the worker and when the
+## claim expires. The status is stored with the etag we last saw, so if
+## another worker got there first, Synapse refuses the update with a 412
+## and we move on. Claims that outlive their expiry time, because the worker
+## died, can be claimed again by anyone. The claim's annotations are removed
+## when the submission's final status is stored.
+
+import os
+import socket
+import time
+import uuid
+
+from synapseclient.annotations import to_submission_status_annotations, from_submission_status_annotations
+from synapseclient.exceptions import SynapseHTTPError
+
+
+IN_PROGRESS = 'EVALUATION_IN_PROGRESS'
+
+CLAIM_ANNOTATIONS = ('claim_phase', 'claim_worker', 'claim_expires')
+
+## seconds before an unfinished claim may be taken by another worker, which
+## should be longer than it ever takes to validate or score a submission
+DEFAULT_CLAIM_TTL = 3600
+
+## identifies this process in the claims it makes
+WORKER_ID = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def claim_of(status):
+    """:returns: a dictionary with the phase, worker and expires of a status's claim, or None"""
+    if status.get('status', None) != IN_PROGRESS or 'annotations' not in status:
+        return None
+    annotations = from_submission_status_annotations(status.annotations)
+    if 'claim_phase' not in annotations:
+        return None
+    return dict(phase=annotations['claim_phase'],
+                worker=annotations.get('claim_worker', None),
+                expires=long(annotations.get('claim_expires', 0)))
+
+
+def expired_claims(bundles, phase, now=None):
+    """Select the bundles whose claims on the given phase have expired"""
+    now_ms = (now or time.time()) * 1000
+    expired = []
+    for submission, status in bundles:
+        claim = claim_of(status)
+        if claim and claim['phase'] == phase and claim['expires'] < now_ms:
+            print "reclaiming %s from %s, whose claim expired" % (submission.id, claim['worker'])
+            expired.append((submission, status))
+    return expired
+
+
+def claim(syn, status, phase, ttl=DEFAULT_CLAIM_TTL, store=None):
+    """
+    Try to claim a submission for the given phase, 'validate' or 'score'.
+
+    :param status: the submission's status, as last seen
+    :param store:  function used to store the status, defaults to syn.store
+    :returns: the stored status if we got the claim, otherwise None
+    """
+    annotations = from_submission_status_annotations(status.annotations) if 'annotations' in status else {}
+    for key in ('objectId', 'scopeId'):
+        annotations.pop(key, None)
+    annotations.update(claim_phase=phase, claim_worker=WORKER_ID,
+                       claim_expires=long((time.time() + ttl) * 1000))
+    status.annotations = to_submission_status_annotations(annotations, is_private=True)
+    status.status = IN_PROGRESS
+    try:
+        return (store or syn.store)(status)
+    except SynapseHTTPError as err:
+        ## someone else updated the status since we saw it
+        if getattr(err, 'response', None) is not None and err.response.status_code == 412:
+            return None
+        raise
+
+
+def release(status):
+    """Remove the annotations of a claim from a status, before it's stored with its outcome"""
+    if 'annotations' not in status:
+        return status
+    annotations = from_submission_status_annotations(status.annotations)
+    if not any(key in annotations for key in CLAIM_ANNOTATIONS):
+        return status
+    for key in CLAIM_ANNOTATIONS + ('objectId', 'scopeId'):
+        annotations.pop(key, None)
+    status.annotations = to_submission_status_annotations(annotations, is_private=True)
+    return status
+
+
+def claim_bundles(syn, bundles, phase, ttl=DEFAULT_CLAIM_TTL, store=None):
+    """
+    Iterate over the bundles we manage to claim, claiming each one as it's
+    reached, so that a worker never holds more claims than it's working on.
+    """
+    for submission, status in bundles:
+        claimed = claim(syn, status, phase, ttl=ttl, store=store)
+        if claimed is None:
+            print "skipping %s, claimed by another worker" % submission.id
+            continue
+        yield submission, claimed
@@ -0,0 +1,188 @@
+## Check delimited submission files against a schema, reading them as a
+## stream so a file of any size is validated in bounded memory. Only the
+## IDs of the rows are kept, to check for duplicates and missing IDs.
+##
+## A schema is a dictionary like this:
+##
+##   dict(columns=[dict(name='id', type='string'),
+##                 dict(name='prediction', type='float', min=0, max=1),
+##                 dict(name='label', type='string', values=['A', 'B'], missing=True)],
+##        id_column='id',           ## optional, checked for duplicates
+##        ids='expected_ids.txt',   ## optional, the IDs every submission must
+##                                  ## have, as a list or a file of one per line,
+##                                  ## needs an id_column
+##        delimiter='\t',           ## defaults to a tab
+##        max_errors=10)            ## stop after this many problems
+##
+## Column types are 'string', 'integer' and 'float'. Numeric columns can
+## have a min and max, and any column can list the values allowed in it.
+## Empty values and NA are allowed only in columns with missing=True. The
+## file must have a header naming the columns, in any order.
+
+import csv
+import gzip
+import math
+
+
+DEFAULT_MAX_ERRORS = 10
+
+## bytes read from the file at a time
+READ_BUFFER_SIZE = 1024*1024
+
+MISSING_VALUES = ('', 'NA', 'NaN', 'nan')
+
+## examples of missing IDs to list in the message
+MAX_MISSING_IDS_SHOWN = 5
+
+## required ID sets by file path, read once per process
+_required_ids = {}
+
+
+class _TooManyErrors(Exception):
+    pass
+
+
+class _Errors(object):
+    def __init__(self, max_errors):
+        self.max_errors = max_errors
+        self.messages = []
+
+    def add(self, message):
+        self.messages.append(message)
+        if len(self.messages) >= self.max_errors:
+            raise _TooManyErrors()
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb', READ_BUFFER_SIZE)
+
+
+def required_ids(ids):
+    """The set of required IDs, from a list or a file with one ID per line"""
+    if not isinstance(ids, basestring):
+        return set(ids)
+    if ids not in _required_ids:
+        with _open(ids) as f:
+            _required_ids[ids] = set(line.strip() for line in f if line.strip())
+    return _required_ids[ids]
+
+
+def check_schema(schema):
+    """Raise ValueError if a schema can't be used to check files"""
+    if 'columns' not in schema:
+        raise ValueError("A submission schema needs a list of columns")
+    if 'ids' in schema and not schema.get('id_column', None):
+        raise ValueError("A submission schema giving the expected ids needs an id_column to find them in")
+
+
+def _convert(value, column):
+    """:returns: the value converted to the column's type, or raises ValueError"""
+    kind = column.get('type', 'string')
+    if kind == 'string':
+        return value
+    if kind == 'integer':
+        return int(value)
+    if kind == 'float':
+        number = float(value)
+        if math.isnan(number) or math.isinf(number):
+            raise ValueError()
+        return number
+    raise ValueError("Unknown column type \"%s\" in the schema" % kind)
+
+
+def _check_value(value, column):
+    """:returns: a description of what's wrong with the value, or None"""
+    if value in MISSING_VALUES:
+        return None if column.get('missing', False) else "is missing a value"
+    try:
+        converted = _convert(value, column)
+    except ValueError:
+        return "has \"%s\", which isn't %s %s" % (value, 'an' if column.get('type') == 'integer' else 'a', column.get('type'))
+    if 'min' in column and converted < column['min']:
+        return "has %s, less than the minimum of %s" % (value, column['min'])
+    if 'max' in column and converted > column['max']:
+        return "has %s, more than the maximum of %s" % (value, column['max'])
+    if 'values' in column and converted not in column['values']:
+        return "has \"%s\", which isn't one of %s" % (value, ", ".join(str(v) for v in column['values']))
+    return None
+
+
+def _check_rows(f, schema, errors):
+    columns = schema['columns']
+    reader = csv.reader(f, delimiter=str(schema.get('delimiter', '\t')))
+
+    header = next(reader, None)
+    if header is None:
+        errors.add("The file is empty.")
+        return 0
+    header = [name.strip() for name in header]
+    id_column = schema.get('id_column', None)
+    missing = [column['name'] for column in columns if column['name'] not in header]
+    if id_column and id_column not in header and id_column not in missing:
+        missing.append(id_column)
+    if missing:
+        errors.add("The header is missing the column%s %s." % ('s' if len(missing) > 1 else '', ", ".join(missing)))
+        return 0
+    extra = [name for name in header if name not in set(column['name'] for column in columns) and name != id_column]
+    if extra:
+        errors.add("The header has unexpected column%s %s." % ('s' if len(extra) > 1 else '', ", ".join(extra)))
+    checks = [(header.index(column['name']), column) for column in columns]
+
+    id_index = header.index(id_column) if id_column else None
+    expected = required_ids(schema['ids']) if 'ids' in schema else None
+    seen = set()
+
+    rows = 0
+    for row in reader:
+        line = reader.line_num
+        ## blank lines, including a trailing one, aren't rows
+        if not row or (len(row) == 1 and not row[0].strip()):
+            continue
+        rows += 1
+        if len(row) != len(header):
+            errors.add("Line %d has %d values, expected %d." % (line, len(row), len(header)))
+            continue
+        for i, column in checks:
+            problem = _check_value(row[i].strip(), column)
+            if problem:
+                errors.add("Line %d: %s %s." % (line, column['name'], problem))
+        if id_index is not None:
+            row_id = row[id_index].strip()
+            if row_id in seen:
+                errors.add("Line %d: %s \"%s\" is repeated." % (line, id_column, row_id))
+            elif expected is not None and row_id not in expected:
+                errors.add("Line %d: %s \"%s\" isn't expected." % (line, id_column, row_id))
+            seen.add(row_id)
+
+    missing_ids = sorted(expected - seen) if expected is not None else []
+    if missing_ids:
+        errors.add("The file is missing %d %s%s, for example %s." % (
+            len(missing_ids), id_column, 's' if len(missing_ids) > 1 else '',
+            ", ".join(missing_ids[:MAX_MISSING_IDS_SHOWN])))
+    return rows
+
+
+def validate_file(path, schema):
+    """
+    Check a file against a schema.
+
+    :returns: (True, message) if the file matches the schema, (False,
+              message) listing the problems found if not, the same as
+              validate_submission in challenge_config
+    """
+    errors = _Errors(schema.get('max_errors', DEFAULT_MAX_ERRORS))
+    try:
+        with _open(path) as f:
+            rows = _check_rows(f, schema, errors)
+    except _TooManyErrors:
+        return False, "Found these problems in your submission, stopping after the first %d:\n%s" % (
+            errors.max_errors, "\n".join(errors.messages))
+    except csv.Error as ex1:
+        errors.messages.append("The file couldn't be read as delimited text: %s" % ex1)
+
+    if errors.messages:
+        return False, "Found %d problem%s in your submission:\n%s" % (
+            len(errors.messages), 's' if len(errors.messages) > 1 else '', "\n".join(errors.messages))
+    return True, "Your submission has %d rows, in the expected format." % rows
@@ -0,0 +1,94 @@
+## Load gold standard files once, rather than parsing them for every
+## submission.
+##
+## The first time a gold standard is loaded it's parsed and saved as a .npy
+## file named for the MD5 of the original, in GOLDSTANDARD_CACHE_DIR. From
+## then on the .npy file is memory-mapped read-only, which costs next to
+## nothing, and the mapping is kept for the life of the process. Worker
+## processes forked after a gold standard is loaded share its pages with
+## the parent instead of reading their own copies.
+
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+
+DEFAULT_CACHE_DIR = "goldstandard_cache"
+
+## memory-mapped arrays by (path, version)
+_loaded = {}
+_lock = threading.Lock()
+
+
+def _md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def checksum(path, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    The MD5 of a file, remembered in the cache directory by the file's size
+    and modification time, so that big files aren't read on every run.
+    """
+    index_path = os.path.join(cache_dir, 'checksums.json')
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        index = {}
+
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    entry = index.get(key, None)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return entry['md5']
+
+    index[key] = dict(size=stat.st_size, mtime=stat.st_mtime, md5=_md5(path))
+    _write_atomically(index_path, lambda f: json.dump(index, f), cache_dir)
+    return index[key]['md5']
+
+
+def _write_atomically(path, write, cache_dir):
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load(path, parse=None, version=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Get a gold standard as a read-only memory-mapped numpy array.
+
+    :param path:    the gold standard file
+    :param parse:   function from the file's path to a numpy array, by
+                    default numpy.loadtxt. The array can't hold Python objects.
+    :param version: change this when the parse function changes, to parse
+                    the file again
+    """
+    key = (os.path.abspath(path), version)
+    with _lock:
+        if key not in _loaded:
+            try:
+                os.makedirs(cache_dir)
+            except OSError as ex1:
+                if ex1.errno != errno.EEXIST:
+                    raise
+            name = checksum(path, cache_dir) + ('_%s' % version if version else '')
+            npy_path = os.path.join(cache_dir, name + '.npy')
+            if not os.path.exists(npy_path):
+                array = np.asarray((parse or np.loadtxt)(path))
+                _write_atomically(npy_path, lambda f: np.save(f, array, allow_pickle=False), cache_dir)
+            _loaded[key] = np.load(npy_path, mmap_mode='r')
+        return _loaded[key]
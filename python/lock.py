@@ -1,18 +1,31 @@
 import argparse
 import errno
 import inspect
+import json
 import os
 import shutil
+import socket
 import sys
+import threading
 import time
+import traceback
+import uuid
 from datetime import timedelta
 
 LOCK_DEFAULT_MAX_AGE = timedelta(hours=2)
 
+## a lease is renewed every interval and considered abandoned by its holder
+## once it's missed this many heartbeats
+LEASE_DEFAULT_INTERVAL = timedelta(seconds=30)
+LEASE_MISSED_HEARTBEATS = 4
+
 
 class LockedException(Exception):
     pass
 
+class LeaseLostException(Exception):
+    pass
+
 def acquire_lock_or_fail(name, max_age=LOCK_DEFAULT_MAX_AGE):
     lock = Lock(name, max_age=max_age)
     if lock.acquire():
@@ -69,6 +82,159 @@ class Lock(object):
                     raise
 
 
+def acquire_lease_or_fail(name, dir=None, interval=LEASE_DEFAULT_INTERVAL):
+    lease = Lease(name, dir=dir, interval=interval)
+    if lease.acquire():
+        return lease
+    raise LockedException("A lease named %s is held by %s" % (name, lease.holder()))
+
+
+class Lease(object):
+    """
+    Implements a lock with a file named [name].lease that the holder renews
+    from a background thread every interval. The file is created with an
+    atomic link and renewed with an atomic rename, and holds the holder's
+    host, pid and the time of its last heartbeat. A lease whose holder has
+    missed LEASE_MISSED_HEARTBEATS heartbeats is taken to be abandoned, so a
+    long but live process keeps its lease however long it runs.
+
+    If the lease is taken by another process or can't be renewed, it's
+    marked lost, and check() raises LeaseLostException so the holder can
+    stop rather than carry on without it.
+    """
+    SUFFIX = 'lease'
+
+    def __init__(self, name, dir=None, interval=LEASE_DEFAULT_INTERVAL):
+        self.name = name
+        self.held = False
+        self.dir = dir if dir else os.getcwd()
+        self.path = os.path.join(self.dir, ".".join([name, Lease.SUFFIX]))
+        self.interval = interval.total_seconds()
+        self.token = uuid.uuid4().hex
+        self.lost = False
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def _record(self):
+        return dict(token=self.token, host=socket.gethostname(), pid=os.getpid(),
+                    heartbeat=time.time(), interval=self.interval)
+
+    def _write_temp(self):
+        temp_path = "%s.%s" % (self.path, self.token)
+        with open(temp_path, 'w') as f:
+            json.dump(self._record(), f)
+        return temp_path
+
+    def _read(self, path=None):
+        try:
+            with open(path or self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _is_stale(self, record):
+        missed = (time.time() - record['heartbeat']) / record.get('interval', self.interval)
+        return missed > LEASE_MISSED_HEARTBEATS
+
+    def holder(self):
+        """Describe the current holder of the lease, or None"""
+        record = self._read()
+        if record is None:
+            return None
+        return "pid %s on %s, last heartbeat %d seconds ago" % (
+            record['pid'], record['host'], time.time() - record['heartbeat'])
+
+    def _break(self, record):
+        """Take away a stale lease, returning False if someone else got to it first"""
+        aside = "%s.stale.%s" % (self.path, self.token)
+        try:
+            os.rename(self.path, aside)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return True
+        moved = self._read(aside)
+        if moved is None or moved['token'] != record['token']:
+            ## the lease was renewed or taken since we looked, put it back
+            try:
+                os.link(aside, self.path)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            os.remove(aside)
+            return False
+        sys.stderr.write("Breaking lease %s held by pid %s on %s, which missed its heartbeats\n" % (
+            self.name, record['pid'], record['host']))
+        os.remove(aside)
+        return True
+
+    def acquire(self):
+        """Try to acquire the lease. Return True on success or False otherwise"""
+        temp_path = self._write_temp()
+        try:
+            for attempt in range(2):
+                try:
+                    os.link(temp_path, self.path)
+                    self.held = True
+                    break
+                except OSError as err:
+                    if err.errno != errno.EEXIST:
+                        raise
+                record = self._read()
+                if record is not None and not self._is_stale(record):
+                    break
+                if record is not None and not self._break(record):
+                    break
+        finally:
+            os.remove(temp_path)
+        if self.held:
+            self.lost = False
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._heartbeat, name='lease ' + self.name)
+            self.thread.daemon = True
+            self.thread.start()
+        return self.held
+
+    def _heartbeat(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                record = self._read()
+                if record is None or record['token'] != self.token:
+                    sys.stderr.write("Lost lease %s to %s\n" % (self.name, self.holder()))
+                    self._lose()
+                    return
+                os.rename(self._write_temp(), self.path)
+            except Exception:
+                sys.stderr.write("Failed to renew lease %s, giving it up:\n%s" % (self.name, traceback.format_exc()))
+                self._lose()
+                return
+
+    def _lose(self):
+        self.held = False
+        self.lost = True
+
+    def check(self):
+        """Raise LeaseLostException if the lease was lost while we held it"""
+        if self.lost:
+            raise LeaseLostException("Lost the lease %s" % self.name)
+
+    def release(self):
+        """Stop renewing the lease and remove it, if it's still ours"""
+        if self.thread:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        ## a lease we failed to renew may still be ours to remove
+        if self.held or self.lost:
+            record = self._read()
+            if record is not None and record['token'] == self.token:
+                try:
+                    os.remove(self.path)
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+            self.held = False
+
 
 def _sleep(seconds=0):
     print "sleeping", seconds, "seconds"
@@ -13,6 +13,10 @@ send_notifications = True
 acknowledge_receipt = False
 dry_run = False
 
+## An Outbox (see outbox.py) through which to send messages in the
+## background, or None to send them right away
+outbox = None
+
 
 ## Edit these URLs to point to your challenge and its support forum
 defaults = dict(
@@ -171,9 +175,14 @@ def error_notification(userIds, **kwargs):
         return send_message(userIds=userIds,
                             subject_template=notification_subject_template,
                             message_template=error_notification_template,
-                            kwargs=kwargs)
+                            kwargs=kwargs,
+                            digest=True)
 
-def send_message(userIds, subject_template, message_template, kwargs):
+def send_message(userIds, subject_template, message_template, kwargs, digest=False):
+    """
+    :param digest: if sending through the outbox, the message may be
+                   combined with others to the same people
+    """
     subject = formatter.format(subject_template, **kwargs)
     message = formatter.format(message_template, **kwargs)
     if dry_run:
@@ -182,6 +191,9 @@ def send_message(userIds, subject_template, message_template, kwargs):
         print "-" * 60
         print message
         return None
+    elif outbox:
+        outbox.put(userIds, subject, message, content_type="text/html", digest=digest)
+        return None
     elif syn:
         response = syn.sendMessage(
             userIds=userIds,
@@ -0,0 +1,310 @@
+## Metrics commonly used to score challenge submissions, written with numpy
+## so that they run in compiled loops rather than Python ones.
+##
+## Each metric takes the gold standard and the predictions as arrays and
+## works along the last axis, so a metric can score one submission, given
+## arrays of shape (n,), or many bootstrap resamples at once, given arrays
+## of shape (resamples, n), as the significance command does.
+##
+## For files too large to load at once, the accumulators at the end of this
+## module take the data a chunk at a time, for example from arrays loaded
+## with numpy.load(path, mmap_mode='r') and sliced with chunks().
+##
+## Leaderboard columns can name the metric they hold with a 'metric' key,
+## for example dict(name='auc', columnType='DOUBLE', metric='auroc'). See
+## score_columns.
+
+import numpy as np
+
+
+## rows per chunk in chunks()
+CHUNK_SIZE = 1000000
+
+## pairs compared at once in cindex
+CINDEX_BLOCK_PAIRS = 10000000
+
+
+def rankdata(values):
+    """
+    Rank values along the last axis, from 1, giving tied values the mean of
+    their ranks.
+    """
+    values = np.asarray(values, dtype=float)
+    shape = values.shape
+    values = values.reshape(-1, shape[-1])
+    m, n = values.shape
+    positions = np.arange(n)
+
+    order = np.argsort(values, axis=1, kind='mergesort')
+    ordered = np.take_along_axis(values, order, axis=1)
+    starts = np.ones((m, n), dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    ends = np.ones((m, n), dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+
+    ## the first and last position of each value's group of ties
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends, positions, n)[:, ::-1], axis=1)[:, ::-1]
+
+    ranks = np.empty((m, n))
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1, axis=1)
+    return ranks.reshape(shape)
+
+
+def rmse(gold, predictions):
+    """Root mean squared error"""
+    gold, predictions = np.asarray(gold, dtype=float), np.asarray(predictions, dtype=float)
+    return np.sqrt(np.mean((gold - predictions)**2, axis=-1))
+
+
+def pearson(gold, predictions):
+    """Pearson correlation"""
+    gold, predictions = np.asarray(gold, dtype=float), np.asarray(predictions, dtype=float)
+    x = gold - gold.mean(axis=-1, keepdims=True)
+    y = predictions - predictions.mean(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (x * y).sum(axis=-1) / np.sqrt((x**2).sum(axis=-1) * (y**2).sum(axis=-1))
+
+
+def spearman(gold, predictions):
+    """Spearman rank correlation"""
+    return pearson(rankdata(gold), rankdata(predictions))
+
+
+def auroc(gold, predictions):
+    """
+    Area under the ROC curve, from the ranks of the predictions as in the
+    Mann-Whitney U statistic, which takes O(n log n) rather than a pass over
+    every threshold.
+
+    :param gold: binary labels, 1 for positive
+    """
+    gold = np.asarray(gold) > 0
+    ranks = rankdata(predictions)
+    positives = gold.sum(axis=-1).astype(float)
+    negatives = gold.shape[-1] - positives
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((ranks * gold).sum(axis=-1) - positives * (positives + 1) / 2) / (positives * negatives)
+
+
+def aupr(gold, predictions):
+    """
+    Area under the precision-recall curve, as average precision. Tied
+    predictions are taken together, at the precision after the last of them.
+
+    :param gold: binary labels, 1 for positive
+    """
+    gold = np.asarray(gold) > 0
+    predictions = np.asarray(predictions, dtype=float)
+    shape = gold.shape[:-1]
+    gold = gold.reshape(-1, gold.shape[-1])
+    predictions = predictions.reshape(gold.shape)
+    m, n = gold.shape
+
+    order = np.argsort(-predictions, axis=1, kind='mergesort')
+    ordered = np.take_along_axis(predictions, order, axis=1)
+    hits = np.take_along_axis(gold, order, axis=1)
+    true_positives = np.cumsum(hits, axis=1)
+
+    ## precision at the last of each group of tied predictions
+    ends = np.ones((m, n), dtype=bool)
+    ends[:, :-1] = ordered[:, 1:] != ordered[:, :-1]
+    last = np.minimum.accumulate(np.where(ends, np.arange(n), n)[:, ::-1], axis=1)[:, ::-1]
+    precision = np.take_along_axis(true_positives, last, axis=1) / (last + 1.0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = (precision * hits).sum(axis=1) / hits.sum(axis=1)
+    return result.reshape(shape) if shape else result[0]
+
+
+def _cindex(time, predictions, event):
+    comparable = 0
+    concordant = 0.0
+    block = max(1, CINDEX_BLOCK_PAIRS // len(time))
+    for start in range(0, len(time), block):
+        stop = start + block
+        ## pairs where the earlier time i is an observed event
+        earlier = (time[start:stop, None] < time[None, :]) & event[start:stop, None]
+        difference = predictions[start:stop, None] - predictions[None, :]
+        comparable += earlier.sum()
+        concordant += ((difference < 0) & earlier).sum() + 0.5 * ((difference == 0) & earlier).sum()
+    return concordant / comparable if comparable else np.nan
+
+
+def cindex(time, predictions, event=None):
+    """
+    Harrell's concordance index, the fraction of comparable pairs whose
+    predicted times are in the same order as their survival times, counting
+    tied predictions as half. Pairs are compared a block at a time to bound
+    the memory used, in O(n^2) time.
+
+    :param time:        survival or censoring times
+    :param predictions: predicted survival times, or negated risks
+    :param event:       1 where the event was observed, 0 where the time was
+                        censored, all observed by default
+    """
+    time, predictions = np.asarray(time, dtype=float), np.asarray(predictions, dtype=float)
+    event = np.ones(time.shape, dtype=bool) if event is None else np.broadcast_to(np.asarray(event) > 0, time.shape)
+    if time.ndim == 1:
+        return _cindex(time, predictions, event)
+    return np.array([_cindex(t, p, e) for t, p, e in zip(time.reshape(-1, time.shape[-1]),
+                                                         predictions.reshape(-1, time.shape[-1]),
+                                                         event.reshape(-1, time.shape[-1]))]).reshape(time.shape[:-1])
+
+
+def _f1(true_positives, false_positives, false_negatives):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 2.0 * true_positives / (2 * true_positives + false_positives + false_negatives)
+
+
+def f1_per_class(gold, predictions, labels=None):
+    """
+    F1 score of each class.
+
+    :param labels: the classes, by default those in the gold standard
+    :returns: a dictionary from each class to its F1 score
+    """
+    gold, predictions = np.asarray(gold), np.asarray(predictions)
+    if labels is None:
+        labels = np.unique(gold)
+    scores = {}
+    for label in labels:
+        actual = gold == label
+        predicted = predictions == label
+        scores[label] = _f1((actual & predicted).sum(axis=-1), (~actual & predicted).sum(axis=-1), (actual & ~predicted).sum(axis=-1))
+    return scores
+
+
+def macro_f1(gold, predictions, labels=None):
+    """Mean of the F1 scores of each class"""
+    return np.mean(list(f1_per_class(gold, predictions, labels).values()), axis=0)
+
+
+METRICS = dict(rmse=rmse, pearson=pearson, spearman=spearman, auroc=auroc, aupr=aupr, cindex=cindex, macro_f1=macro_f1)
+
+
+def get(name):
+    """Look up a metric by name"""
+    if name not in METRICS:
+        raise ValueError("Unknown metric \"%s\", expected one of %s" % (name, ", ".join(sorted(METRICS))))
+    return METRICS[name]
+
+
+def score_columns(columns, gold, predictions):
+    """
+    Compute the metric of each leaderboard column that names one.
+
+    :param columns: leaderboard column configurations, as in challenge_config.leaderboard_columns
+    :returns: a dictionary from column name to score, suitable for returning from score_submission
+    """
+    return {column['name']: float(get(column['metric'])(gold, predictions))
+            for column in columns if 'metric' in column}
+
+
+def chunks(gold, predictions, chunk_size=CHUNK_SIZE):
+    """Iterate over matching slices of the gold standard and predictions"""
+    for start in range(0, len(gold), chunk_size):
+        yield np.asarray(gold[start:start+chunk_size]), np.asarray(predictions[start:start+chunk_size])
+
+
+## Accumulators compute a metric over data given a chunk at a time through
+## add(gold, predictions). Only 1-D chunks are supported.
+
+class RMSE(object):
+    def __init__(self):
+        self.n = 0
+        self.squared_error = 0.0
+
+    def add(self, gold, predictions):
+        gold, predictions = np.asarray(gold, dtype=float), np.asarray(predictions, dtype=float)
+        self.n += len(gold)
+        self.squared_error += ((gold - predictions)**2).sum()
+
+    def value(self):
+        return np.sqrt(self.squared_error / self.n) if self.n else np.nan
+
+
+class Pearson(object):
+    """Combines the means and sums of squares of each chunk, as in Chan et al.'s parallel variance"""
+    def __init__(self):
+        self.n = 0
+        self.mean = np.zeros(2)
+        self.comoments = np.zeros((2, 2))
+
+    def add(self, gold, predictions):
+        data = np.vstack((np.asarray(gold, dtype=float), np.asarray(predictions, dtype=float)))
+        n = data.shape[1]
+        if n == 0:
+            return
+        mean = data.mean(axis=1)
+        centered = data - mean[:, None]
+        delta = mean - self.mean
+        total = self.n + n
+        self.comoments += centered.dot(centered.T) + np.outer(delta, delta) * self.n * n / total
+        self.mean += delta * n / total
+        self.n = total
+
+    def value(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.comoments[0, 1] / np.sqrt(self.comoments[0, 0] * self.comoments[1, 1])
+
+
+class F1(object):
+    """Per class F1 scores, from confusion counts for the given classes"""
+    def __init__(self, labels):
+        self.labels = list(labels)
+        self.counts = np.zeros((len(self.labels), 3), dtype=np.int64)
+
+    def add(self, gold, predictions):
+        gold, predictions = np.asarray(gold), np.asarray(predictions)
+        for i, label in enumerate(self.labels):
+            actual = gold == label
+            predicted = predictions == label
+            self.counts[i] += ((actual & predicted).sum(), (~actual & predicted).sum(), (actual & ~predicted).sum())
+
+    def value(self):
+        """:returns: a dictionary from each class to its F1 score"""
+        return dict(zip(self.labels, _f1(*self.counts.T.astype(float))))
+
+
+class BinnedCurve(object):
+    """
+    AUROC and AUPR over chunks, from counts of positives and negatives in
+    bins of the predictions. Predictions falling in the same bin count as
+    tied, so the result is exact when there are no more distinct predictions
+    than bins, and otherwise within the resolution of the bins.
+
+    :param edges: increasing bin edges covering the range of the predictions,
+                  by default 10000 bins between 0 and 1
+    """
+    def __init__(self, edges=None):
+        self.edges = np.linspace(0, 1, 10001) if edges is None else np.asarray(edges, dtype=float)
+        self.positives = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.negatives = np.zeros(len(self.edges) + 1, dtype=np.int64)
+
+    def add(self, gold, predictions):
+        gold = np.asarray(gold) > 0
+        bins = np.searchsorted(self.edges, np.asarray(predictions, dtype=float), side='right')
+        self.positives += np.bincount(bins[gold], minlength=len(self.positives))
+        self.negatives += np.bincount(bins[~gold], minlength=len(self.negatives))
+
+    def _descending(self):
+        ## cumulative counts from the highest bin down, skipping empty bins
+        positives, negatives = self.positives[::-1], self.negatives[::-1]
+        used = (positives + negatives) > 0
+        return positives[used], np.cumsum(positives[used]), np.cumsum(negatives[used])
+
+    def auroc(self):
+        positives, true_positives, false_positives = self._descending()
+        total_positives, total_negatives = float(true_positives[-1]), float(false_positives[-1])
+        ## trapezoids under the ROC curve, which count ties within a bin as half
+        tpr = np.r_[0, true_positives] / total_positives
+        fpr = np.r_[0, false_positives] / total_negatives
+        with np.errstate(invalid='ignore'):
+            return np.trapz(tpr, fpr)
+
+    def aupr(self):
+        positives, true_positives, false_positives = self._descending()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            precision = true_positives / (true_positives + false_positives).astype(float)
+            return (precision * positives).sum() / true_positives[-1]
@@ -0,0 +1,230 @@
+## A persistent queue of messages to participants and admins, delivered by
+## a background thread so that validating and scoring never wait on
+## Synapse's messaging service.
+
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+
+SCHEMA = """
+create table if not exists outbox (
+    id integer primary key autoincrement,
+    user_ids text not null,
+    subject text,
+    body text,
+    content_type text,
+    digest integer not null default 0,
+    created real not null,
+    attempts integer not null default 0,
+    next_attempt real not null,
+    error text,
+    state text not null default 'pending',
+    owner text,
+    claimed real);
+create index if not exists outbox_state on outbox (state, next_attempt);
+"""
+
+## columns added since the first version of the outbox file
+MIGRATIONS = [
+    ("owner", "alter table outbox add column owner text"),
+    ("claimed", "alter table outbox add column claimed real")]
+
+## first retry after a failed send, doubling with each further attempt
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 3600
+
+## a message claimed for sending by a process that hasn't finished with it
+## in this many seconds is taken to be abandoned and sent again
+CLAIM_TIMEOUT = 600
+
+
+class Outbox(object):
+    """
+    Messages are written to a SQLite file and sent in the order they were
+    put by a background thread, at no more than max_rate messages per second.
+    A failed send is retried with exponential backoff, up to max_attempts.
+    Messages put with digest=True are held for up to digest_interval seconds
+    and then sent to each set of recipients as a single message.
+
+    Several processes can share one outbox file. Each message is claimed
+    with an atomic update before it's sent, so only one of them sends it,
+    and a claim left behind by a process that died is given up after
+    CLAIM_TIMEOUT seconds.
+
+    :param syn:             a logged in Synapse object
+    :param path:            SQLite file holding the outbox, messages left
+                            unsent by one run are sent by the next
+    :param max_rate:        messages per second
+    :param max_attempts:    give up on a message after this many failures
+    :param digest_interval: seconds to collect digest messages
+    """
+    def __init__(self, syn, path, max_rate=1.0, max_attempts=5, digest_interval=600):
+        self.syn = syn
+        self.path = path
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.max_attempts = max_attempts
+        self.digest_interval = digest_interval
+        self.lock = threading.Lock()
+        self.owner = "%s:%d:%s" % (socket.gethostname(), os.getpid(), id(self))
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute("pragma table_info(outbox)")]
+        for column, statement in MIGRATIONS:
+            if column not in columns:
+                self.db.execute(statement)
+        self.db.commit()
+        self.last_sent = 0.0
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='outbox')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, user_ids, subject, body, content_type="text/html", digest=False):
+        """Queue a message to be sent, returning right away"""
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "insert into outbox (user_ids, subject, body, content_type, digest, created, next_attempt) values (?,?,?,?,?,?,?)",
+                (json.dumps([str(user_id) for user_id in user_ids]), subject, body, content_type, 1 if digest else 0, now, now))
+            self.db.commit()
+        self.wakeup.set()
+
+    def pending(self):
+        """:returns: the number of messages waiting to be sent"""
+        with self.lock:
+            return self.db.execute("select count(*) from outbox where state='pending'").fetchone()[0]
+
+    def _claim(self, ids, now):
+        """:returns: those of the given ids that this outbox claimed for sending"""
+        claimed = []
+        with self.lock:
+            for id in ids:
+                cursor = self.db.execute(
+                    "update outbox set state='sending', owner=?, claimed=? where id=? and state='pending'",
+                    (self.owner, now, id))
+                if cursor.rowcount == 1:
+                    claimed.append(id)
+            self.db.commit()
+        return claimed
+
+    def _expire_claims(self, now):
+        """Put messages claimed by a process that has gone away back in the queue"""
+        with self.lock:
+            self.db.execute(
+                "update outbox set state='pending', owner=null, claimed=null "
+                "where state='sending' and claimed<?", (now - CLAIM_TIMEOUT,))
+            self.db.commit()
+
+    def _next_message(self, now):
+        while True:
+            with self.lock:
+                row = self.db.execute(
+                    "select id, user_ids, subject, body, content_type, attempts from outbox "
+                    "where state='pending' and digest=0 and next_attempt<=? order by id limit 1", (now,)).fetchone()
+            if row is None or self._claim([row[0]], now):
+                return row
+
+    def _due_digests(self, now, flushing):
+        """:returns: {user_ids: rows} for the digests that are ready to send"""
+        with self.lock:
+            rows = self.db.execute(
+                "select id, user_ids, subject, body, content_type, attempts, created from outbox "
+                "where state='pending' and digest=1 and next_attempt<=? order by id", (now,)).fetchall()
+        digests = {}
+        for row in rows:
+            digests.setdefault(row[1], []).append(row)
+        due = {}
+        for user_ids, rows in digests.items():
+            if flushing or now - rows[0][6] >= self.digest_interval:
+                claimed = set(self._claim([row[0] for row in rows], now))
+                rows = [row for row in rows if row[0] in claimed]
+                if rows:
+                    due[user_ids] = rows
+        return due
+
+    def _send(self, ids, user_ids, subject, body, content_type, attempts):
+        ## keep to the rate limit
+        delay = self.last_sent + self.min_interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.last_sent = time.time()
+        try:
+            response = self.syn.sendMessage(
+                userIds=json.loads(user_ids),
+                messageSubject=subject,
+                messageBody=body,
+                contentType=content_type)
+            print "sent: ", unicode(response).encode('utf-8')
+            self._update(ids, state='sent', attempts=attempts + 1, error=None, owner=None, claimed=None)
+        except Exception as ex1:
+            attempts += 1
+            error = traceback.format_exc()
+            if attempts >= self.max_attempts:
+                sys.stderr.write("Giving up on message \"%s\" after %d attempts:\n%s\n" % (subject, attempts, error))
+                self._update(ids, state='failed', attempts=attempts, error=error, owner=None, claimed=None)
+            else:
+                delay = min(RETRY_DELAY * 2**(attempts - 1), MAX_RETRY_DELAY)
+                sys.stderr.write("Failed to send message \"%s\", retrying in %d seconds: %s\n" % (subject, delay, ex1))
+                self._update(ids, state='pending', attempts=attempts, error=error, next_attempt=time.time() + delay,
+                             owner=None, claimed=None)
+
+    def _update(self, ids, **fields):
+        columns = sorted(fields)
+        with self.lock:
+            self.db.executemany(
+                "update outbox set %s where id=?" % ", ".join("%s=?" % column for column in columns),
+                [[fields[column] for column in columns] + [id] for id in ids])
+            self.db.commit()
+
+    def _deliver(self, flushing):
+        """Send the next due message or digest, returning False if there's none"""
+        now = time.time()
+        self._expire_claims(now)
+        row = self._next_message(now)
+        if row:
+            self._send([row[0]], *row[1:])
+            return True
+        digests = self._due_digests(now, flushing)
+        for user_ids, rows in digests.items():
+            if len(rows) == 1:
+                subject, body = rows[0][2], rows[0][3]
+            else:
+                subject = "%d errors from the scoring script" % len(rows)
+                body = "\n<hr>\n".join(row[3] for row in rows)
+            self._send([row[0] for row in rows], user_ids, subject, body, rows[0][4], max(row[5] for row in rows))
+        return bool(digests)
+
+    def _run(self):
+        while True:
+            flushing = self.stopping.is_set()
+            try:
+                delivered = self._deliver(flushing)
+            except Exception:
+                traceback.print_exc()
+                delivered = False
+            if not delivered:
+                if flushing:
+                    return
+                self.wakeup.wait(1.0)
+                self.wakeup.clear()
+
+    def close(self, timeout=None):
+        """
+        Send whatever is due, including any digests collected so far, and
+        stop the sender. Messages waiting to be retried stay in the file.
+        """
+        self.stopping.set()
+        self.wakeup.set()
+        self.thread.join(timeout)
+        remaining = self.pending()
+        with self.lock:
+            self.db.close()
+        if remaining:
+            print "%d messages left in the outbox %s" % (remaining, self.path)
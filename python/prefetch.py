@@ -0,0 +1,140 @@
+## Download submission files ahead of validation and scoring.
+
+import json
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+
+DEFAULT_PREFETCH_BYTES = 2*1024**3
+
+
+def file_handle(submission):
+    """
+    Find the file handle of the entity in a submission's entity bundle, or
+    return None if the submission has no file.
+    """
+    if 'entityBundleJSON' not in submission:
+        return None
+    bundle = json.loads(submission['entityBundleJSON'])
+    file_handles = bundle.get('fileHandles', [])
+    data_file_handle_id = bundle.get('entity', {}).get('dataFileHandleId', None)
+    for fh in file_handles:
+        if fh.get('id', None) == data_file_handle_id:
+            return fh
+    return file_handles[0] if file_handles else None
+
+
+def content_md5(submission):
+    """MD5 of a submission's file as recorded by Synapse, or None"""
+    fh = file_handle(submission)
+    return fh.get('contentMd5', None) if fh else None
+
+
+def file_size(submission):
+    """Size in bytes of a submission's file or 0 if unknown"""
+    fh = file_handle(submission)
+    return int(fh.get('contentSize', 0)) if fh else 0
+
+
+class Prefetcher(object):
+    """
+    Iterates over (submission, status) bundles, downloading the files of
+    upcoming submissions in background threads while the caller works on
+    the current one.
+
+    With hold=True, the files of submissions that have been yielded still
+    count against max_bytes until the caller passes them to release(), for
+    callers that queue several submissions up for a pool of workers.
+    """
+    def __init__(self, syn, bundles, lookahead, max_bytes=DEFAULT_PREFETCH_BYTES, fetch=None, hold=False, submit=None):
+        self.syn = syn
+        self.fetch = fetch or syn.getSubmission
+        self.submit = submit
+        self.bundles = iter(bundles)
+        self.lookahead = lookahead
+        self.max_bytes = max_bytes
+        self.hold = hold
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.next_bundle = None
+        self.lock = threading.Lock()
+
+    def _fill(self, submit):
+        while len(self.pending) < self.lookahead:
+            if self.next_bundle is None:
+                try:
+                    self.next_bundle = next(self.bundles)
+                except StopIteration:
+                    return
+            size = file_size(self.next_bundle[0])
+            with self.lock:
+                ## the next submission is always fetched, however big it is
+                if self.pending and self.pending_bytes + size > self.max_bytes:
+                    return
+                self.pending_bytes += size
+            submission, status = self.next_bundle
+            self.next_bundle = None
+            self.pending.append((size, status, submit(self.fetch, submission)))
+
+    def __iter__(self):
+        pool = None
+        submit = self.submit
+        if submit is None:
+            pool = ThreadPool(processes=self.lookahead)
+            submit = lambda function, *args: pool.apply_async(function, args)
+        try:
+            self._fill(submit)
+            while self.pending:
+                size, status, result = self.pending.popleft()
+                submission = result.get()
+                if not self.hold:
+                    self._release(size)
+                self._fill(submit)
+                yield submission, status
+            if pool:
+                pool.close()
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+    def _release(self, size):
+        with self.lock:
+            self.pending_bytes -= size
+
+    def release(self, submission):
+        """Stop counting a yielded submission's file against max_bytes"""
+        if self.hold:
+            self._release(file_size(submission))
+
+
+def prefetch_submissions(syn, bundles, lookahead=0, max_bytes=DEFAULT_PREFETCH_BYTES, fetch=None, hold=False, submit=None):
+    """
+    Iterate over (submission, status) bundles, refetching each submission so
+    that its file gets downloaded.
+
+    :param lookahead: how many submissions to download ahead of the caller,
+                      0 downloads each one just before it's yielded
+    :param max_bytes: limit on the total size of files downloaded ahead of
+                      the caller
+    :param fetch:     function used in place of syn.getSubmission
+    :param hold:      keep counting yielded files against max_bytes until
+                      they're passed to the returned iterator's release()
+    :param submit:    function(function, *args) returning an AsyncResult,
+                      to download on an existing pool of threads rather
+                      than one of lookahead threads
+    """
+    fetch = fetch or syn.getSubmission
+    if lookahead > 0:
+        return Prefetcher(syn, bundles, lookahead, max_bytes, fetch, hold=hold, submit=submit)
+    return ((fetch(submission), status) for submission, status in bundles)
+
+
+def release(submissions, submission):
+    """
+    Tell the iterator returned by prefetch_submissions that the caller is
+    done with a submission's file, if it's keeping count.
+    """
+    if isinstance(submissions, Prefetcher):
+        submissions.release(submission)
@@ -0,0 +1,130 @@
+## Rank the scored submissions to a queue by the metrics on its leaderboard.
+##
+## A leaderboard column is ranked if its configuration in
+## challenge_config.leaderboard_columns has a 'rank' key, either
+## 'descending' (higher is better) or 'ascending' (lower is better). An
+## optional 'rank_ties' key says how tied values are ranked:
+##
+##   min:     tied values share the best of their ranks (1, 2, 2, 4), the default
+##   max:     tied values share the worst of their ranks (1, 3, 3, 4)
+##   average: tied values share the mean of their ranks (1, 2.5, 2.5, 4)
+##   dense:   like min, without gaps after ties (1, 2, 2, 3)
+##   ordinal: ties are broken in the order the submissions are listed (1, 2, 3, 4)
+
+import numpy as np
+
+
+TIES = ('min', 'max', 'average', 'dense', 'ordinal')
+
+
+def ranked_columns(columns):
+    """Select the leaderboard columns configured to be ranked"""
+    return [column for column in columns if column.get('rank', None) in ('ascending', 'descending')]
+
+
+def rank_values(values, descending=True, ties='min'):
+    """
+    Rank an array of values, best first. Missing values (NaN) aren't ranked
+    and get a rank of NaN.
+
+    :returns: an array of ranks starting from 1, floats so as to hold NaN
+    """
+    if ties not in TIES:
+        raise ValueError("Unknown way to rank ties: \"%s\"" % ties)
+    values = np.asarray(values, dtype=float)
+    ranks = np.full(len(values), np.nan)
+    present = np.flatnonzero(~np.isnan(values))
+    n = len(present)
+    if n == 0:
+        return ranks
+
+    keys = -values[present] if descending else values[present]
+    ## a stable sort keeps tied values in the order they were listed
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+
+    if ties == 'ordinal':
+        ranked = np.arange(1, n + 1, dtype=float)
+    else:
+        starts_group = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+        group = np.cumsum(starts_group) - 1
+        first = np.flatnonzero(starts_group) + 1
+        last = np.r_[first[1:] - 1, n]
+        if ties == 'min':
+            ranked = first[group].astype(float)
+        elif ties == 'max':
+            ranked = last[group].astype(float)
+        elif ties == 'average':
+            ranked = (first[group] + last[group]) / 2.0
+        else:
+            ranked = (group + 1).astype(float)
+
+    ranks[present[order]] = ranked
+    return ranks
+
+
+def team_ranks(ranks, teams, ties='min'):
+    """
+    Rank teams by their best submission.
+
+    :param ranks: submission ranks, as returned by rank_values
+    :param teams: an array of team names, one per submission
+    :returns: (team rank of each submission's team, whether each submission
+              is its team's best), with ties between a team's submissions
+              going to the first listed
+    """
+    ranks = np.asarray(ranks, dtype=float)
+    if len(ranks) == 0:
+        return np.full(0, np.nan), np.zeros(0, dtype=bool)
+    team_names, team_index = np.unique(np.asarray(teams), return_inverse=True)
+
+    ## NaN sorts after every rank, so unranked submissions never count as best
+    order = np.lexsort((np.arange(len(ranks)), np.where(np.isnan(ranks), np.inf, ranks), team_index))
+    first_of_team = np.r_[True, team_index[order][1:] != team_index[order][:-1]]
+    best = order[first_of_team]
+
+    best_rank = np.full(len(team_names), np.nan)
+    best_rank[team_index[best]] = ranks[best]
+    team_rank = rank_values(best_rank, descending=False, ties=ties)
+
+    is_best = np.zeros(len(ranks), dtype=bool)
+    is_best[best] = ~np.isnan(ranks[best])
+    return team_rank[team_index], is_best
+
+
+def rank_table(annotations, teams, columns):
+    """
+    Compute the ranks of all submissions to a queue.
+
+    :param annotations: a list of dictionaries of each submission's scores
+    :param teams:       a list of each submission's team or user name
+    :param columns:     leaderboard column configurations
+    :returns: a list holding a dictionary for each submission with a
+              [name]_rank, [name]_team_rank and [name]_team_best annotation
+              for each ranked column, None for missing values
+    """
+    rows = [{} for _ in annotations]
+    for column in ranked_columns(columns):
+        name = column['name']
+        ties = column.get('rank_ties', 'min')
+        values = np.array([_to_float(scores.get(name, None)) for scores in annotations], dtype=float)
+        ranks = rank_values(values, descending=(column['rank'] == 'descending'), ties=ties)
+        team_rank, is_best = team_ranks(ranks, teams, ties=ties)
+        for row, rank, team, best in zip(rows, ranks.tolist(), team_rank.tolist(), is_best.tolist()):
+            row[name + '_rank'] = _annotation_value(rank, ties)
+            row[name + '_team_rank'] = _annotation_value(team, ties)
+            row[name + '_team_best'] = 'true' if best else 'false'
+    return rows
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _annotation_value(rank, ties):
+    if np.isnan(rank):
+        return None
+    return rank if ties == 'average' else int(rank)
@@ -0,0 +1,132 @@
+## Run a validation or scoring function in a child process with limits on
+## wall clock time, CPU time and memory, so one pathological submission
+## can't hold up the rest of the queue.
+
+import cPickle as pickle
+import errno
+import os
+import resource
+import select
+import signal
+import sys
+import time
+import traceback
+
+
+class LimitExceeded(Exception):
+    """The function was stopped for exceeding one of its limits"""
+    pass
+
+
+class ChildError(Exception):
+    """
+    The function raised an exception in the child process. The message is
+    the original exception's, and the traceback attribute holds the child's
+    formatted traceback.
+    """
+    def __init__(self, message, traceback):
+        super(ChildError, self).__init__(message)
+        self.traceback = traceback
+
+
+def _child(function, args, write_fd, cpu_time, memory):
+    if memory:
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    if cpu_time:
+        ## SIGXCPU at the soft limit, SIGKILL a second later
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_time, cpu_time + 1))
+    try:
+        result = ('ok', function(*args))
+    except MemoryError:
+        result = ('memory', traceback.format_exc())
+    except Exception as ex1:
+        result = ('error', (str(ex1), traceback.format_exc()))
+    try:
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception as ex1:
+        ## a result, or an exception, that can't be sent back to the parent
+        data = pickle.dumps(('error', ("Can't return the result from the child process: %s" % ex1,
+                                       traceback.format_exc())), pickle.HIGHEST_PROTOCOL)
+    with os.fdopen(write_fd, 'wb') as f:
+        f.write(data)
+
+
+def _read_result(read_fd, pid, wall_time):
+    """Read the child's pickled result, killing it if it runs out of time"""
+    deadline = time.time() + wall_time if wall_time else None
+    chunks = []
+    while True:
+        timeout = max(0, deadline - time.time()) if deadline else None
+        try:
+            ready, _, _ = select.select([read_fd], [], [], timeout)
+        except select.error as err:
+            if err.args[0] == errno.EINTR:
+                continue
+            raise
+        if not ready:
+            os.kill(pid, signal.SIGKILL)
+            return None
+        chunk = os.read(read_fd, 1024*1024)
+        if not chunk:
+            return ''.join(chunks)
+        chunks.append(chunk)
+
+
+def run(function, args=(), wall_time=None, cpu_time=None, memory=None):
+    """
+    Call function(*args) in a forked child process and return its result,
+    which must be picklable.
+
+    :param wall_time: seconds the call may take
+    :param cpu_time:  seconds of CPU time the call may use
+    :param memory:    bytes of address space the child may use. Linux does
+                      not enforce limits on resident memory, so this limits
+                      virtual memory, which is somewhat larger.
+
+    The child is forked from whichever thread calls run(). If another thread
+    holds a lock at that moment, say in the logging module or the Synapse
+    client, the child can block on it forever, so callers running in a pool
+    of threads should give a wall_time.
+    :raises LimitExceeded: if the call went over one of its limits
+    :raises ChildError: if the function raised an exception
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        ## never return into the parent's code from the child
+        try:
+            os.close(read_fd)
+            _child(function, args, write_fd, cpu_time, memory)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            ## os._exit skips the flush of Python's buffers at exit
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(0)
+
+    os.close(write_fd)
+    try:
+        data = _read_result(read_fd, pid, wall_time)
+    finally:
+        os.close(read_fd)
+        _, status = os.waitpid(pid, 0)
+
+    if data is None:
+        raise LimitExceeded("Stopped after running for more than %s seconds" % wall_time)
+    if os.WIFSIGNALED(status):
+        signum = os.WTERMSIG(status)
+        if cpu_time and signum in (signal.SIGXCPU, signal.SIGKILL):
+            raise LimitExceeded("Stopped after using more than %s seconds of CPU time" % cpu_time)
+        raise LimitExceeded("Stopped by signal %d" % signum)
+    if not data:
+        raise LimitExceeded("Exited without a result, possibly for lack of memory")
+
+    outcome, value = pickle.loads(data)
+    if outcome == 'memory':
+        raise LimitExceeded("Stopped after running out of memory, the limit is %s bytes" % memory)
+    if outcome == 'error':
+        raise ChildError(*value)
+    return value
@@ -0,0 +1,61 @@
+## Orders in which to validate and score the submissions waiting in a queue.
+## The order doesn't change how long a queue takes to drain, but in a burst
+## it changes how long each participant waits for their result.
+
+from collections import OrderedDict
+from itertools import izip_longest
+
+import prefetch
+
+
+POLICIES = ('fifo', 'sjf', 'fair', 'oldest')
+
+
+def _submitter(submission):
+    return submission.get('teamId', None) or submission.get('userId', None)
+
+
+def _created_on(bundle):
+    ## Synapse's ISO 8601 timestamps sort in time order as strings
+    return bundle[0].get('createdOn', '')
+
+
+def shortest_first(bundles):
+    """Smallest files first, so quick submissions don't wait behind big ones"""
+    return sorted(bundles, key=lambda bundle: prefetch.file_size(bundle[0]))
+
+
+def oldest_first(bundles):
+    return sorted(bundles, key=_created_on)
+
+
+def round_robin(bundles):
+    """
+    Take one submission from each team or user in turn, oldest first, so a
+    submitter with many submissions in the queue doesn't hold up everyone else.
+    """
+    by_submitter = OrderedDict()
+    for bundle in oldest_first(bundles):
+        by_submitter.setdefault(_submitter(bundle[0]), []).append(bundle)
+    return [bundle for turn in izip_longest(*by_submitter.values())
+            for bundle in turn if bundle is not None]
+
+
+def order(bundles, policy='fifo'):
+    """
+    Order a list of (submission, status) bundles by a scheduling policy:
+
+    fifo:   as listed by Synapse
+    sjf:    shortest job first, by the size of the submitted file
+    fair:   round robin across teams or users
+    oldest: by time of submission
+    """
+    if policy == 'fifo':
+        return list(bundles)
+    if policy == 'sjf':
+        return shortest_first(bundles)
+    if policy == 'fair':
+        return round_robin(bundles)
+    if policy == 'oldest':
+        return oldest_first(bundles)
+    raise ValueError("Unknown scheduling policy: \"%s\"" % policy)
@@ -0,0 +1,107 @@
+## Bootstrap confidence intervals and Bayes factors for the top submissions
+## to a queue, as reported with the final results of a challenge.
+##
+## Rather than calling a scoring function once per resample, all the
+## resamples are drawn up front as a matrix of indices into the gold
+## standard, and the metric is evaluated on many resamples at once with
+## numpy, in chunks spread over a pool of processes. A metric is a function
+## of two arrays of shape (resamples, n), the resampled gold standard and
+## predictions, returning an array of shape (resamples,).
+
+import multiprocessing
+import signal
+
+import numpy as np
+
+
+DEFAULT_RESAMPLES = 1000
+DEFAULT_TOP = 10
+DEFAULT_CONFIDENCE = 0.95
+
+## number of resamples each task given to a worker process evaluates
+CHUNK_SIZE = 50
+
+## the arrays the worker processes work on, set before they're forked so
+## they're shared with the workers rather than pickled for every task
+_shared = {}
+
+
+def bootstrap_indices(n, resamples, seed=None):
+    """:returns: a (resamples, n) matrix of indices, each row drawing n of n items with replacement"""
+    return np.random.RandomState(seed).randint(0, n, size=(resamples, n), dtype=np.int32)
+
+
+def _init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _evaluate_chunk(bounds):
+    start, stop = bounds
+    metric = _shared['metric']
+    rows = _shared['indices'][start:stop]
+    gold = _shared['gold'][rows]
+    return np.array([metric(gold, predictions[rows]) for predictions in _shared['predictions']], dtype=float)
+
+
+def bootstrap(metric, gold, predictions, resamples=DEFAULT_RESAMPLES, processes=1, seed=None, chunk_size=CHUNK_SIZE):
+    """
+    Evaluate a metric for several submissions on the same bootstrap resamples.
+
+    :param metric:      a batched metric, as described above
+    :param gold:        the gold standard, an array of n values
+    :param predictions: a (submissions, n) array of each submission's predictions
+    :param processes:   number of processes to evaluate resamples in
+    :returns: a (submissions, resamples) array of the metric's values
+    """
+    gold = np.asarray(gold)
+    predictions = np.asarray(predictions)
+    if predictions.ndim != 2 or predictions.shape[1] != len(gold):
+        raise ValueError("Expected predictions for each of the %d items in the gold standard, got an array of shape %s"
+                         % (len(gold), predictions.shape))
+
+    _shared.update(metric=metric, gold=gold, predictions=predictions,
+                   indices=bootstrap_indices(len(gold), resamples, seed))
+    chunks = [(start, min(start + chunk_size, resamples)) for start in range(0, resamples, chunk_size)]
+    try:
+        if processes > 1:
+            pool = multiprocessing.Pool(processes=processes, initializer=_init_worker)
+            try:
+                results = pool.map(_evaluate_chunk, chunks)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = [_evaluate_chunk(chunk) for chunk in chunks]
+    finally:
+        _shared.clear()
+    return np.hstack(results)
+
+
+def confidence_intervals(samples, confidence=DEFAULT_CONFIDENCE):
+    """:returns: arrays of the lower and upper percentile bounds of each row of samples"""
+    tail = (1.0 - confidence) / 2 * 100
+    low, high = np.nanpercentile(samples, [tail, 100 - tail], axis=1)
+    return low, high
+
+
+def bayes_factors(samples, best, descending=True):
+    """
+    The Bayes factor of the best submission over each of the others: the
+    number of resamples on which the best did better, over the number on
+    which the other did at least as well. When the other never did as well,
+    the factor is the number of resamples the best won. A factor under 3 is
+    usually taken to mean the two can't be told apart.
+
+    :param samples:    a (submissions, resamples) array, as returned by bootstrap
+    :param best:       the row of the best submission
+    :param descending: True if higher values of the metric are better
+    :returns: an array of factors, NaN for the best submission itself
+    """
+    difference = samples[best] - samples if descending else samples - samples[best]
+    valid = ~np.isnan(difference)
+    wins = ((difference > 0) & valid).sum(axis=1)
+    losses = valid.sum(axis=1) - wins
+    factors = wins / np.maximum(losses, 1).astype(float)
+    factors[best] = np.nan
+    return factors
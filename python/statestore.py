@@ -0,0 +1,220 @@
+## A local SQLite mirror of the submissions to a challenge and their
+## statuses, so that read-only commands can be answered without going back
+## to Synapse and write commands can tell what has changed.
+
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from synapseclient import Submission, SubmissionStatus
+from synapseclient.annotations import from_submission_status_annotations, to_submission_status_annotations
+
+
+SCHEMA = """
+create table if not exists submissions (
+    id text primary key,
+    evaluation_id text not null,
+    status text,
+    user_id text,
+    team_id text,
+    name text,
+    created_on text,
+    modified_on text,
+    etag text,
+    submission text,
+    submission_status text);
+create index if not exists submissions_evaluation_status on submissions (evaluation_id, status);
+create index if not exists submissions_user on submissions (user_id);
+create index if not exists submissions_team on submissions (team_id);
+create index if not exists submissions_modified_on on submissions (evaluation_id, modified_on);
+"""
+
+## the fields of a submission query row that belong to the submission and its
+## status, the rest are the status's annotations
+QUERY_SUBMISSION_FIELDS = {'objectId': 'id', 'userId': 'userId', 'teamId': 'teamId', 'entityId': 'entityId',
+                           'versionNumber': 'versionNumber', 'name': 'name', 'createdOn': 'createdOn',
+                           'submitterId': 'submitterId', 'submitterAlias': 'submitterAlias',
+                           'repositoryName': 'repositoryName', 'dockerDigest': 'dockerDigest'}
+QUERY_STATUS_FIELDS = ('status', 'modifiedOn', 'scopeId')
+
+
+class StateStore(object):
+    """
+    Keeps the most recent submission bundles seen for each evaluation in a
+    SQLite file, indexed by evaluation, status, user, team and modifiedOn.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def record_bundle(self, submission, status):
+        """
+        Store a submission and its status.
+
+        :returns: True if the submission is new or its status has changed
+                  since we last saw it
+        """
+        return self.record_bundles([(submission, status)])[0]
+
+    def record_bundles(self, bundles):
+        """
+        Store (submission, status) bundles, such as a page of them, in one
+        transaction.
+
+        :returns: a list saying for each bundle whether the submission is new
+                  or its status has changed since we last saw it
+        """
+        with self.lock:
+            changed = [self._record_bundle(submission, status) for submission, status in bundles]
+            self.db.commit()
+        return changed
+
+    def _record_bundle(self, submission, status):
+        row = self.db.execute("select etag from submissions where id=?", (submission['id'],)).fetchone()
+        changed = row is None or row[0] != status.get('etag', None)
+        if changed:
+            self.db.execute(
+                "insert or replace into submissions values (?,?,?,?,?,?,?,?,?,?,?)",
+                (submission['id'], submission['evaluationId'], status.get('status', None),
+                 submission.get('userId', None), submission.get('teamId', None), submission.get('name', None),
+                 submission.get('createdOn', None), status.get('modifiedOn', None), status.get('etag', None),
+                 json.dumps(_without_file(submission)), json.dumps(status)))
+        return changed
+
+    def record_status(self, status):
+        """Update the status of a submission we've already recorded"""
+        self.record_statuses([status])
+
+    def record_statuses(self, statuses):
+        """Update the statuses of submissions we've already recorded, in one transaction"""
+        with self.lock:
+            self.db.executemany(
+                "update submissions set status=?, modified_on=?, etag=?, submission_status=? where id=?",
+                [(status.get('status', None), status.get('modifiedOn', None), status.get('etag', None),
+                  json.dumps(status), status['id']) for status in statuses])
+            self.db.commit()
+
+    def record_query_rows(self, evaluation_id, headers, rows):
+        """
+        Update the store from the rows of a submission query. A row holds a
+        submission's fields, status and annotations, but not its etag, so
+        changed statuses are recorded without one and the next sync fills it
+        in. Submissions we haven't seen are added from what the row holds.
+        Rows without an objectId and status are skipped.
+
+        :returns: the number of submissions added or changed
+        """
+        changed = 0
+        with self.lock:
+            for values in rows:
+                fields = dict(zip(headers, values))
+                if fields.get('objectId', None) is None or fields.get('status', None) is None:
+                    continue
+                submission_id = unicode(fields['objectId'])
+                modified_on = _query_time(fields.get('modifiedOn', None))
+                annotations = {name: value for name, value in fields.items()
+                               if name not in QUERY_SUBMISSION_FIELDS and name not in QUERY_STATUS_FIELDS and value is not None}
+                row = self.db.execute("select status, modified_on, submission_status from submissions where id=?",
+                                      (submission_id,)).fetchone()
+                if row is None:
+                    submission = {key: fields[name] for name, key in QUERY_SUBMISSION_FIELDS.items()
+                                  if fields.get(name, None) is not None}
+                    submission.update(id=submission_id, evaluationId=evaluation_id,
+                                      createdOn=_query_time(fields.get('createdOn', None)))
+                    status = dict(id=submission_id, status=fields['status'], modifiedOn=modified_on)
+                    if annotations:
+                        status['annotations'] = to_submission_status_annotations(annotations, is_private=True)
+                    self.db.execute(
+                        "insert into submissions values (?,?,?,?,?,?,?,?,?,?,?)",
+                        (submission_id, evaluation_id, status['status'], submission.get('userId', None),
+                         submission.get('teamId', None), submission.get('name', None), submission['createdOn'],
+                         modified_on, None, json.dumps(submission), json.dumps(status)))
+                elif row[0] != fields['status'] or (modified_on and row[1] != modified_on):
+                    status = json.loads(row[2])
+                    status.update(status=fields['status'], modifiedOn=modified_on or status.get('modifiedOn', None))
+                    status.pop('etag', None)
+                    if annotations:
+                        merged = from_submission_status_annotations(status['annotations']) if 'annotations' in status else {}
+                        for key in ('objectId', 'scopeId'):
+                            merged.pop(key, None)
+                        merged.update(annotations)
+                        status['annotations'] = to_submission_status_annotations(merged, is_private=True)
+                    self.db.execute(
+                        "update submissions set status=?, modified_on=?, etag=null, submission_status=? where id=?",
+                        (status['status'], status['modifiedOn'], json.dumps(status), submission_id))
+                else:
+                    continue
+                changed += 1
+            self.db.commit()
+        return changed
+
+    def remove_missing(self, evaluation_id, submission_ids):
+        """Forget submissions to the evaluation that aren't in submission_ids"""
+        with self.lock:
+            known = set(row[0] for row in self.db.execute("select id from submissions where evaluation_id=?", (evaluation_id,)))
+            missing = known - set(submission_ids)
+            self.db.executemany("delete from submissions where id=?", [(submission_id,) for submission_id in missing])
+            self.db.commit()
+            return len(missing)
+
+    def get(self, submission_id):
+        """:returns: a (submission, status) tuple or None"""
+        with self.lock:
+            row = self.db.execute("select submission, submission_status from submissions where id=?", (str(submission_id),)).fetchone()
+        return _bundle(row) if row else None
+
+    def bundles(self, evaluation_id, status=None):
+        """:returns: a list of (submission, status) tuples, oldest first"""
+        sql = "select submission, submission_status from submissions where evaluation_id=?"
+        params = [evaluation_id]
+        if status:
+            sql += " and status=?"
+            params.append(status)
+        with self.lock:
+            rows = self.db.execute(sql + " order by created_on", params).fetchall()
+        return [_bundle(row) for row in rows]
+
+    def leaderboard_rows(self, evaluation_id, status='SCORED'):
+        """
+        :returns: a list of dictionaries holding the fields a submission query
+                  would return: submission fields plus status annotations
+        """
+        rows = []
+        for submission, submission_status in self.bundles(evaluation_id, status=status):
+            fields = {'objectId': submission['id'],
+                      'userId': submission.get('userId', None),
+                      'entityId': submission.get('entityId', None),
+                      'versionNumber': submission.get('versionNumber', None),
+                      'name': submission.get('name', None),
+                      'createdOn': submission.get('createdOn', None),
+                      'status': submission_status.get('status', None),
+                      'modifiedOn': submission_status.get('modifiedOn', None)}
+            if 'annotations' in submission_status:
+                fields.update(from_submission_status_annotations(submission_status['annotations']))
+            rows.append(fields)
+        return rows
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def _without_file(submission):
+    ## the local file path and the entity fetched along with it are only
+    ## meaningful on this machine, for this run
+    return {key: value for key, value in submission.items() if key not in ('filePath', 'entity')}
+
+
+def _query_time(value):
+    """Turn a time from a submission query, in ms since the epoch, into the form of a bundle's"""
+    if value is None or (isinstance(value, basestring) and not value.isdigit()):
+        return value
+    return datetime.utcfromtimestamp(long(value) / 1000.0).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def _bundle(row):
+    return Submission(**json.loads(row[0])), SubmissionStatus(**json.loads(row[1]))
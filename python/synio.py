@@ -0,0 +1,129 @@
+## Keep many Synapse requests in flight from one process. Requests share a
+## pool of keep-alive connections and can be limited per endpoint, so a
+## burst of lookups doesn't open a connection per call or flood one API.
+
+import threading
+import urlparse
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from synapseclient import exceptions
+from synapseclient.retry import _with_retry
+
+
+DEFAULT_MAX_IN_FLIGHT = 32
+
+
+class SynapseIO(object):
+    """
+    Runs Synapse REST calls on a pool of threads sharing one requests
+    session. submit() returns a multiprocessing AsyncResult whose get()
+    method waits for the result.
+
+    :param syn:             a logged in Synapse object
+    :param max_in_flight:   number of requests to have in flight at once,
+                            which is also the size of the connection pool
+    :param endpoint_limits: a dictionary from the start of a REST path,
+                            relative to the repo, file or auth endpoint, for
+                            example '/evaluation/submission/query', to the
+                            number of requests allowed in flight to it
+    """
+    def __init__(self, syn, max_in_flight=DEFAULT_MAX_IN_FLIGHT, endpoint_limits=None):
+        self.syn = syn
+        self.max_in_flight = max_in_flight
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_in_flight)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        ## longest prefix first, so the most specific limit applies
+        self.limits = sorted(((prefix.rstrip('/'), threading.BoundedSemaphore(n))
+                              for prefix, n in (endpoint_limits or {}).items()),
+                             key=lambda limit: -len(limit[0]))
+        self.pool = ThreadPool(processes=max_in_flight)
+
+    def _semaphore(self, uri):
+        for endpoint in (self.syn.repoEndpoint, self.syn.fileHandleEndpoint, self.syn.authEndpoint):
+            if uri.startswith(endpoint):
+                uri = uri[len(endpoint):]
+                break
+        path = urlparse.urlparse(uri).path
+        for prefix, semaphore in self.limits:
+            if path == prefix or path.startswith(prefix + '/'):
+                return semaphore
+        return None
+
+    def _request(self, method, uri, endpoint=None, headers=None, retryPolicy={}, **kwargs):
+        syn = self.syn
+        uri, headers = syn._build_uri_and_headers(uri, endpoint, headers)
+        retryPolicy = syn._build_retry_policy(retryPolicy)
+        semaphore = self._semaphore(uri)
+
+        def send():
+            ## hold the endpoint's slot for the request, not the retry backoff
+            if semaphore:
+                with semaphore:
+                    return self.session.request(method, uri, headers=headers, **kwargs)
+            return self.session.request(method, uri, headers=headers, **kwargs)
+
+        response = _with_retry(send, verbose=syn.debug, **retryPolicy)
+        exceptions._raise_for_status(response, verbose=syn.debug)
+        return response
+
+    ## blocking calls, with the same signatures as the client's rest methods
+
+    def rest_get(self, uri, endpoint=None, headers=None, retryPolicy={}, **kwargs):
+        response = self._request('GET', uri, endpoint, headers, retryPolicy, **kwargs)
+        return self.syn._return_rest_body(response)
+
+    def rest_post(self, uri, body, endpoint=None, headers=None, retryPolicy={}, **kwargs):
+        response = self._request('POST', uri, endpoint, headers, retryPolicy, data=body, **kwargs)
+        return self.syn._return_rest_body(response)
+
+    def rest_put(self, uri, body=None, endpoint=None, headers=None, retryPolicy={}, **kwargs):
+        response = self._request('PUT', uri, endpoint, headers, retryPolicy, data=body, **kwargs)
+        return self.syn._return_rest_body(response)
+
+    def rest_delete(self, uri, endpoint=None, headers=None, retryPolicy={}, **kwargs):
+        self._request('DELETE', uri, endpoint, headers, retryPolicy, **kwargs)
+
+    def install(self):
+        """
+        Send all of the client's REST calls (getSubmission, store, tableQuery
+        and so on) through this engine's connections and endpoint limits.
+        """
+        self.syn.restGET = self.rest_get
+        self.syn.restPOST = self.rest_post
+        self.syn.restPUT = self.rest_put
+        self.syn.restDELETE = self.rest_delete
+
+    def uninstall(self):
+        for name in ('restGET', 'restPOST', 'restPUT', 'restDELETE'):
+            self.syn.__dict__.pop(name, None)
+
+    ## asynchronous calls
+
+    def submit(self, function, *args, **kwargs):
+        """Call a function on the engine's threads"""
+        return self.pool.apply_async(function, args, kwargs)
+
+    def imap(self, function, items):
+        """
+        Like itertools.imap, but with up to max_in_flight calls running at
+        once. Results come back in order. Don't call this from a function
+        running on the engine, which could wait on itself.
+        """
+        pending = deque()
+        for item in items:
+            pending.append(self.submit(function, item))
+            while len(pending) > self.max_in_flight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        self.uninstall()
+        self.pool.close()
+        self.pool.join()
+        self.session.close()